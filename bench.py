@@ -0,0 +1,283 @@
+'''time LoChord's hot methods one at a time on made up states, with a fake MIDI port, and catch anything that got slower.
+
+python bench.py                          # run everything, compare with bench_baseline.json if there is one
+python bench.py --save                   # run everything and make that the new baseline
+python bench.py --only strum             # just the benchmarks with "strum" in their name
+python bench.py --tolerance 0.1          # fail if anything is more than 10% slower than the baseline
+
+timings are per call, best of several rounds, so they only mean something compared with a baseline from the same machine
+'''
+import os
+import sys
+import argparse
+import gc
+import json
+import random
+import time
+from itertools import product
+from evdev.events import InputEvent
+import lochord
+from replay import MockMidiOut
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# every chord the stick can pick, with and without guitar and bass mode, in every inversion
+STATES = list(product([*lochord.CHORD_NAMES_CIRCLE, "main"], (False, True), (False, True), range(3)))
+
+
+def fresh() -> lochord.LoChord:
+    '''a LoChord playing into a fake port, with a calibrated trigger'''
+    lochord.TRIGGER_DEPTH = 255
+    lochord.midi_out = MockMidiOut()
+    lc = lochord.LoChord()
+    lc.midi.output = lambda message: None # keep the port's list from growing for the whole run
+    return lc
+
+
+def set_state(lc: lochord.LoChord, chord: str, guitar: bool, bass: bool, inversion: int) -> None:
+    lc.guitar_mode = guitar
+    lc.bass_mode = bass
+    for change in lc.changes.values():
+        change[1] = inversion
+    lc.current_chord = chord
+    lc.generate_scale(chord)
+
+
+def bench_generate_scale_build():
+    '''every voicing built from scratch'''
+    lc = fresh()
+    def run() -> int:
+        for state in STATES:
+            lc.voicings.clear()
+            lc.voicing_state = None
+            set_state(lc, *state)
+        return len(STATES)
+    return run
+
+
+def bench_generate_scale_cached():
+    '''every voicing coming out of the cache'''
+    lc = fresh()
+    for state in STATES:
+        set_state(lc, *state)
+    def run() -> int:
+        for state in STATES:
+            lc.voicing_state = None
+            set_state(lc, *state)
+        return len(STATES)
+    return run
+
+
+def held_states(lc: lochord.LoChord) -> list[tuple]:
+    '''chords and voicing state for every state in STATES, to swap in without going through generate_scale'''
+    voicings = []
+    for state in STATES:
+        set_state(lc, *state)
+        voicings.append( (lc.chords, lc.voicing_state) )
+    return voicings
+
+
+def bench_change_on_the_fly():
+    '''moving the stick while one, two and three buttons are held'''
+    lc = fresh()
+    voicings = held_states(lc)
+    def run() -> int:
+        calls = 0
+        for held in (1, 2, 3):
+            lc.all_notes_off()
+            lc.chords, lc.voicing_state = voicings[0]
+            for key in lochord.BTN_NAMES[:held]:
+                lc.play_key(key)
+            for lc.chords, lc.voicing_state in voicings:
+                lc.change_on_the_fly()
+                lc.midi.flush()
+            calls += len(voicings)
+        return calls
+    return run
+
+
+def bench_transition():
+    '''the note diff change_on_the_fly caches, worked out every time'''
+    lc = fresh()
+    voicings = held_states(lc)
+    lc.chords, lc.voicing_state = voicings[0]
+    for key in lochord.BTN_NAMES[:2]:
+        lc.play_key(key)
+    lc.midi.flush()
+    def run() -> int:
+        for lc.chords, lc.voicing_state in voicings:
+            lc.transition()
+        return len(voicings)
+    return run
+
+
+def bench_play_release(strum: bool):
+    def bench():
+        lc = fresh()
+        lc.strum_mode = strum
+        voicings = held_states(lc)
+        def run() -> int:
+            for lc.chords, lc.voicing_state in voicings:
+                for key in lochord.BTN_NAMES:
+                    lc.play_key(key)
+                    lc.release_key(key)
+                lc.midi.flush()
+            return len(voicings) * len(lochord.BTN_NAMES) * 2
+        return run
+    bench.__doc__ = f"play_key then release_key on every button, strum mode {'on' if strum else 'off'}"
+    return bench
+
+
+def bench_try_strum():
+    '''full strokes in and out over every chord size, slow and fast'''
+    lc = fresh()
+    lc.strum_mode = True
+    voicings = held_states(lc)
+    def run() -> int:
+        calls = 0
+        for lc.chords, lc.voicing_state in voicings[::3]: # inversions don't change the chord size
+            lc.chord_to_strum[:] = lc.chords[lochord.BTN_NAMES[0]]
+            for step in (8, 32):
+                strokes = [ *range(0, 256, step), 255, *range(255, -1, -step), 0 ]
+                for pressure in strokes:
+                    lc.try_strum(pressure)
+                lc.midi.flush()
+                calls += len(strokes)
+        return calls
+    return run
+
+
+def bench_interpret_joystick():
+    '''the stick swept round every chord and back to the middle'''
+    lc = fresh()
+    positions = []
+    for angle in range(0, 360, 5):
+        for radius in (0.3, 0.6, 0.95):
+            x = lochord.math.sin(lochord.math.radians(angle)) * radius
+            y = -lochord.math.cos(lochord.math.radians(angle)) * radius
+            positions.append( (int(x * 32767), int(y * 32767)) )
+    def run() -> int:
+        for lc.joystick[0], lc.joystick[1] in positions:
+            lc.interpret_joystick()
+        lc.midi.flush()
+        return len(positions)
+    return run
+
+
+def bench_frames(method: str, strum: bool):
+    def bench():
+        lc = fresh()
+        lc.strum_mode = strum
+        handle = getattr(lc, method)
+        ecodes = lochord.ecodes
+        buttons = { name: code for code, name in lc.key_codes.items() }
+        axes = { name: code for code, name in lc.axis_codes.items() }
+        keys = [ buttons[name] for name in lochord.BTN_NAMES if name in buttons ]
+        rnd = random.Random(1)
+        events = []
+        down = set()
+        trigger = 0
+        stamp = 0.0
+        for i in range(2000): # a made up performance: buttons, stick and trigger, one change per frame
+            r = rnd.random()
+            if r < 0.3:
+                code = rnd.choice(keys)
+                (down.discard if code in down else down.add)(code)
+                change = (ecodes.EV_KEY, code, int(code in down))
+            elif r < 0.5:
+                change = (ecodes.EV_ABS, axes[rnd.choice(["ABS_X", "ABS_Y"])], rnd.choice([0, 30000, -30000, 20000, -20000, 100]))
+            else:
+                trigger = max(0, min(255, trigger + rnd.choice([-60, -30, 30, 60])))
+                change = (ecodes.EV_ABS, axes["ABS_RZ"], trigger)
+            for type, code, value in (change, (ecodes.EV_SYN, ecodes.SYN_REPORT, 0)):
+                stamp += 0.002
+                events.append( InputEvent(int(stamp), int(stamp % 1 * 1_000_000), type, code, value) )
+        def run() -> int:
+            for event in events:
+                handle(event)
+            return len(events)
+        return run
+    bench.__doc__ = f"a stream of synthetic controller frames through {method}, strum mode {'on' if strum else 'off'}"
+    return bench
+
+
+BENCHMARKS = {
+    "generate_scale build": bench_generate_scale_build,
+    "generate_scale cached": bench_generate_scale_cached,
+    "change_on_the_fly": bench_change_on_the_fly,
+    "transition": bench_transition,
+    "play_key/release_key": bench_play_release(False),
+    "play_key/release_key strum": bench_play_release(True),
+    "try_strum": bench_try_strum,
+    "interpret_joystick": bench_interpret_joystick,
+    "queue_event_linux": bench_frames("queue_event_linux", False), # the default, COALESCE_FRAMES
+    "queue_event_linux strum": bench_frames("queue_event_linux", True),
+    "process_frame_linux": bench_frames("process_frame_linux", False),
+    "process_frame_linux strum": bench_frames("process_frame_linux", True),
+}
+
+
+def measure(setup, rounds: int, min_time: float) -> float:
+    '''seconds per call, from the fastest of several rounds. each round repeats the pass until it's taken min_time'''
+    run = setup()
+    run() # warm up caches the same way a real session would
+    best = float("inf")
+    for i in range(rounds):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            calls += run()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark LoChord's hot methods and compare with a baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file to compare with or --save to")
+    parser.add_argument("--save", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="how much slower than the baseline is a failure (0.25 = 25%%)")
+    parser.add_argument("--only", default="", help="only run benchmarks with this in their name")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds each round runs for at least")
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+    lochord.DO_RUMBLE = False
+    gc.disable() # collections landing in one round but not another are most of the noise
+    results = {}
+    failed = []
+    for name, setup in BENCHMARKS.items():
+        if args.only not in name:
+            continue
+        seconds = measure(setup, args.rounds, args.min_time)
+        results[name] = seconds
+        line = f"{name:28} {seconds * 1e6:9.2f} us"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f"  {change:+7.1%} vs baseline"
+            if change > args.tolerance:
+                line += "  SLOWER"
+                failed.append(name)
+        print(line, flush=True)
+    gc.enable()
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump({ "python": sys.version.split()[0], "results": results }, file, indent=1)
+        print(f"Saved baseline to {args.baseline}.")
+    elif not baseline:
+        print("No baseline to compare with. Run with --save to make one.")
+    if failed:
+        print(f"{len(failed)} benchmark(s) more than {args.tolerance:.0%} slower than the baseline: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,112 @@
 CONTROLLER_NAME = "X-box"
 DO_RUMBLE = True
+RUMBLE_LEVELS = 8 # how many rumble strengths get uploaded to the controller at startup
 TRIGGER_DEPTH = 0 # run the script and follow the instructions.
 POLL_RATE = 125 # Hertz
 DEADZONE = 0.5 # how far from center does the stick have to move to change chords
+STICK_ANGLE_HYSTERESIS = 6 # degrees the stick has to go past a chord's edge before switching to the next one
+STICK_RADIUS_HYSTERESIS = 0.05 # the stick engages a chord at DEADZONE + this and lets go at DEADZONE - this
+STICK_TABLE_BITS = 7 # the joystick lookup table has 2**this steps per axis
+CONTROL_MAP = {} # linux: remap controls by evdev name, e.g. {"BTN_TL": "BTN_TR", "BTN_TR": "BTN_TL"} swaps the bumpers
 
 CHANNEL = 0  # MIDI channel 1
+BASS_CHANNEL = -1 # bass mode's extra low notes go out on this channel (0 is channel 1) instead of CHANNEL. -1 keeps them together
 MIDI_PORT_NAME = "LoChord"
+OUTPUTS = [] # more places to send everything to, on top of MIDI_PORT_NAME. each one gets its own writer thread
+#   {"type": "virtual", "name": "LoChord DAW"}         another virtual port (not on windows)
+#   {"type": "port", "name": "USB MIDI"}               an existing port, found by part of its name
+#   {"type": "udp", "host": "127.0.0.1", "port": 9000} raw MIDI bytes in UDP packets, e.g. for a visualizer
+#   {"type": "null"}                                   throws everything away, for benchmarking
 
 VELOCITY_SENSITIVITY = 2
 STRUM_WEIGHT = -0.15 # biases velocity towards notes at one end of the strum
+STRUM_CURVE = "classic" # how strum speed turns into velocity: "classic" (shaped by VELOCITY_SENSITIVITY), "linear", "soft", "hard", "fixed" or one of yours
+TRIGGER_CURVE = "linear" # how the right trigger sets velocity outside strum mode. same choices. select + d-pad left/right cycles the current mode's curve
+VELOCITY_CURVES = {} # your own curves as (in, out) points from 0 to 127, joined by straight lines. e.g. {"gentle": [(0, 30), (127, 100)]}
+
+CC_MAP = {} # send continuous controllers from axes, e.g. {"ABS_RX": "pitchbend", "ABS_RY": 1} for pitch bend and mod wheel on the right stick
+CC_MAX_RATE = 100 # most messages per second for each controller. the value it settles on always gets sent
+CC_THRESHOLD = 1 # smallest change worth sending straight away, in CC steps (pitch bend's 14 bits count 128 to a step)
+
+VOICING_CACHE_SIZE = 256 # how many generated chord layouts to remember before dropping the oldest
+TRANSITION_CACHE_SIZE = 512 # how many chord-to-chord changes to remember before dropping the oldest
+BATCH_MIDI = True # send each input frame's MIDI in one go, skipping messages that would do nothing
+COALESCE_FRAMES = True # linux: wait for SYN_REPORT and apply each controller frame once instead of event by event
+MIDI_THREAD = False # send MIDI from its own thread so slow input handling (rumble, printing, saving) can't delay notes
+MIDI_QUEUE_SIZE = 1024 # how many messages the MIDI thread can fall behind by before it starts dropping them
+MIDI_SCHEDULE_DELAY = 0.0 # seconds. above 0, the MIDI thread sends every message exactly this long after it was played (constant latency, no jitter)
+MEASURE_LATENCY = False # linux: time every controller event to its MIDI going out. report on exit or with `kill -USR1`
+EMBEDDED = False # linux: real-time mode for a dedicated box like a pi. asks for real-time priority, pins to a core, locks memory, pre-builds tables and keeps the garbage collector out of the way
+RT_PRIORITY = 50 # embedded: SCHED_FIFO priority for LoChord's threads, 1 to 99
+RT_CPU = -1 # embedded: core to pin LoChord to. -1 is the last one
+GC_THRESHOLD = 50_000 # embedded: allocations between garbage collector passes. python's default is 700
+METRICS_SOCKET = "" # linux: unix socket path that hands a JSON snapshot of live counters to anything that connects. blank to turn off
+PROFILE_SECONDS = 10 # linux: `kill -USR2` profiles the input thread for this long, then prints the busiest functions
+RECORD_EVENTS = "" # linux: file to record the raw controller events to, for replaying with replay.py
+RECORD_MIDI = "" # file to record everything LoChord plays to, as a standard MIDI file (.mid). blank to turn off
+RECORD_MIDI_FLUSH = 1.0 # seconds between writes of the MIDI recording to disk, so a crash loses at most this much
+SAVE_DIR = "" # folder the save slots live in. blank means the folder you run LoChord from
+MULTI_CONTROLLER = False # linux: play every connected controller matching CONTROLLER_NAME at once, each with its own LoChord
+MULTI_CONTROLLER_OUTPUT = "channel" # "channel": player n plays on MIDI channel CHANNEL+n-1. "port": player n gets its own virtual port
+RATE_REPORT_INTERVAL = 10 # seconds between event rate printouts in multi-controller mode. 0 to turn off
+
+TEMPO = 120.0 # beats per minute for the arpeggiator and MIDI clock, unless following someone else's clock
+ARPEGGIATOR = "" # "up", "down" or "updown" arpeggiates the held chord in strum mode. blank to turn off
+ARP_RATE = 4 # arpeggiator notes per beat. 1, 2, 3, 4, 6, 8, 12 or 24
+ARP_GATE = 0.5 # how much of each arpeggiator step the note is held for
+MIDI_CLOCK = "" # "send": send MIDI clock at TEMPO. "follow": take the tempo from MIDI clock coming in. blank for neither
+MIDI_CLOCK_INPUT = "" # follow: part of the name of the MIDI input the clock comes in on. blank takes the first one
 
 CHORD_NAMES_CIRCLE = ["maj/min", "7", "maj/min7", "maj/min9", "sus4", "sus2", "dim", "aug"]
 # clockwise from the top
-# you can swap these out! (coming soon)
+# you can swap these out for anything in CHORDS, or the name of a scale for that scale's triads
 # default is ["maj/min", "7", "maj/min7", "maj/min9", "sus4", "sus2", "dim", "aug"]
 
+SCALES = {
+    "maj": [2, 2, 1, 2, 2, 2, 1],
+    "min": [2, 1, 2, 2, 1, 2, 2],
+}
+# steps in semitones between the notes of each scale, adding up to an octave. the scale degree buttons play its first seven notes
+# add modes here, e.g. "dorian": [2, 1, 2, 2, 2, 1, 2]. main + d-pad up/down steps through them in order
+SCALE_PARTNERS = {"maj": "min", "min": "maj"} # the "maj/min" chord borrows each degree's triad from this scale
+
+CHORDS = {
+    "maj/min":  {"scale": "partner", "notes": ["d0", "d2", "d4"], "guitar": ["d7", "d9"], "bass": True},
+    "7":        {"notes": [0, 4, 7, 10], "guitar": [12], "bass": True},
+    "maj/min7": {"notes": ["d0", "d2", "d4", "d7"], "guitar": ["d7"], "bass": True}, # this probably works for all except dim
+    "maj/min9": {"notes": ["d0", "d2", "d4", "d9"], "guitar": ["d11"], "bass": True}, # probably all except diminished
+    "sus4":     {"notes": [0, 5, 7], "guitar": [12, 17], "bass": True},
+    "sus2":     {"notes": [0, 2, 7], "guitar": [12, 14], "bass": True},
+    "dim":      {"notes": [0, 3, 6], "guitar": [12, 15], "bass": True},
+    "aug":      {"notes": [0, 4, 8], "guitar": [12, 16], "bass": True},
+    "minimal9": {"notes": ["d0", "d9"]}, # tonic and 9th nothing else
+    "perfect5": {"notes": [0, 7]},
+}
+# every chord is built on each scale degree of the main scale ("scale": "partner" uses SCALE_PARTNERS instead).
+# notes are semitones above that root, or "dN" for the note N scale steps above it ("d2" is the diatonic third).
+# guitar mode adds the "guitar" notes, and bass mode adds the root an octave down if "bass" is set
 
+
+import time
+STARTED = time.perf_counter() # for the embedded mode startup report
 import rtmidi
 import math
-import numpy as np
-import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+import threading
+import signal
+import struct
+import asyncio
+import os
+import queue
+import json
+import socket
+import cProfile
+import pstats
+import gc
+import ctypes
+import heapq
+import select
 from sys import platform
 WIN = platform == "win32"
 if not WIN:
@@ -32,7 +119,7 @@ if not WIN:
         "BTN_TL", # left bumper
         "ABS_Z"   # left trigger
     ]
-    from evdev import InputDevice, list_devices, categorize, ecodes, ff
+    from evdev import InputDevice, list_devices, ecodes, ff
 else:
     BTN_NAMES = [
         "BTN_SOUTH", # A
@@ -46,13 +133,1336 @@ else:
     class InputDevice:
         pass
     from inputs import devices, get_gamepad
-    import ctypes
     import atexit
-    import threading
 
 
-class LoChord:
+# velocity curves take and give a velocity from 0 to 127
+CURVES = {
+    "classic": lambda x: 127 * (1 - (1 - x / 127) ** VELOCITY_SENSITIVITY),
+    "linear": lambda x: x,
+    "soft": lambda x: 127 * (1 - (1 - x / 127) ** 3),
+    "hard": lambda x: 127 * (x / 127) ** 2,
+    "fixed": lambda x: 127,
+}
+
+
+def points_curve(points: list[ tuple[float, float] ], name: str = ""):
+    '''a velocity curve joining the given (in, out) points with straight lines'''
+    for x, y in points:
+        if not 0 <= y <= 127:
+            raise ValueError(f"Velocity curve '{name}' has a point at {(x, y)}, but velocities only go from 0 to 127")
+    points = sorted(points)
+    def curve(x: float) -> float:
+        if x <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if x <= x1:
+                return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+        return points[-1][1]
+    return curve
+
+
+
+class Vocabulary:
+    '''SCALES and CHORDS compiled into interval rows: for every chord type, main scale, guitar and bass setting, each scale
+    degree's notes in semitones above the tonic. building a voicing is then just adding the key and octave to a row,
+    however many chords and scales there are'''
+    def __init__(self, scales: dict[ str, list[int] ], partners: dict[str, str], chords: dict[str, dict]) -> None:
+        self.scales: dict[ str, list[int] ] = {} # each scale's notes in semitones above the tonic
+        for name, steps in scales.items():
+            if sum(steps) != 12:
+                raise ValueError(f"The steps of scale '{name}' add up to {sum(steps)} semitones, not an octave")
+            self.scales[name] = [ sum(steps[:i]) for i in range(len(steps)) ]
+        self.partners = partners
+        # a scale's name plays that scale's own triads, which is what the "main" chord does
+        self.shapes: dict[str, dict] = { name: {"scale": name, "notes": ["d0", "d2", "d4"], "guitar": ["d7", "d9"], "bass": True}
+            for name in scales }
+        self.shapes.update(chords)
+        self.rows: dict[ tuple[str, str, bool, bool], list[ tuple[int, ...] ] ] = {}
+        for chord in self.shapes:
+            for scale in self.scales:
+                for guitar in (False, True):
+                    for bass in (False, True):
+                        self.rows[chord, scale, guitar, bass] = self.compile(chord, scale, guitar, bass)
+
+
+    def compile(self, chord: str, main_scale: str, guitar: bool, bass: bool) -> list[ tuple[int, ...] ]:
+        shape = self.shapes[chord]
+        scale = shape.get("scale", "main")
+        if scale == "main":
+            scale = main_scale
+        elif scale == "partner":
+            scale = self.partners.get(main_scale, main_scale)
+        if scale not in self.scales:
+            raise ValueError(f"Chord '{chord}' uses unknown scale '{scale}'")
+        notes = shape["notes"] + (shape.get("guitar", []) if guitar else [])
+        degrees = self.scales[scale]
+        size = len(degrees)
+        rows = []
+        for step in range(len(BTN_NAMES)):
+            root = step // size * 12 + degrees[step % size]
+            row = []
+            for note in notes:
+                if isinstance(note, str): # scale steps above the root
+                    degree = step + int(note.lstrip("d"))
+                    row.append( degree // size * 12 + degrees[degree % size] )
+                else: # semitones above the root
+                    row.append(root + note)
+            if bass and shape.get("bass"):
+                row.append(root - 12)
+            rows.append( tuple(row) )
+        return rows
+
+
+    def next_scale(self, scale: str, step: int) -> str:
+        names = list(self.scales)
+        return names[ (names.index(scale) + step) % len(names) ]
+
+
+
+def sleep_until(deadline: float) -> None:
+    '''sleep most of the way, then give the last bit up in tiny slices. time.sleep alone can overshoot, and a plain spin
+    would hold the GIL and hold up the input thread'''
+    remaining = deadline - time.perf_counter()
+    if remaining > 0.0005:
+        time.sleep(remaining - 0.0005)
+    while time.perf_counter() < deadline:
+        time.sleep(0) # lets other threads run
+
+
+
+class Timer:
+    '''a call booked on an EventLoop. cancel() it like an asyncio TimerHandle'''
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback, args: tuple) -> None:
+        self.callback = callback
+        self.args = args
+        self.cancelled: bool = False
+
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+
+class EventLoop:
+    '''one thread waiting on everything at once: the controller, control sockets and timers. timers sit in a heap and a
+    single timerfd is set for whichever is due first, so when nothing's happening nothing wakes up. linux only.
+    time, call_at, call_later, add_reader and remove_reader work like asyncio's, so code that books timers can be handed either'''
+    def __init__(self) -> None:
+        self.epoll = select.epoll()
+        self.readers: dict[ int, tuple ] = {} # fd -> (callback, args)
+        self.timers: list[ tuple[float, int, Timer] ] = [] # heap of (when, order booked, timer)
+        self.booked: int = 0
+        self.armed: float = 0.0 # when the timerfd goes off, 0 if it's not set
+        self.running: bool = False
+        self.wakeups: int = 0
+        self.fired: int = 0
+        self.timerfd: int = -1
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.timerfd = self.libc.timerfd_create(1, 0o4000 | 0o2000000) # CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC
+        except (OSError, AttributeError):
+            pass
+        if self.timerfd >= 0:
+            self.epoll.register(self.timerfd, select.EPOLLIN)
+        # without one, epoll's own timeout does the job to within a millisecond or so
+
+
+    def time(self) -> float:
+        return time.monotonic() # CLOCK_MONOTONIC, same as the timerfd
+
+
+    def call_at(self, when: float, callback, *args) -> Timer:
+        timer = Timer(callback, args)
+        heapq.heappush(self.timers, (when, self.booked, timer))
+        self.booked += 1
+        if self.timerfd >= 0 and (not self.armed or when < self.armed):
+            self.set_timer(when) # straight away, in case we're nested in another loop that isn't about to ask
+        return timer
+
+
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        return self.call_at(self.time() + delay, callback, *args)
+
+
+    def add_reader(self, fd: int, callback, *args) -> None:
+        self.readers[fd] = (callback, args)
+        self.epoll.register(fd, select.EPOLLIN)
+
+
+    def remove_reader(self, fd: int) -> bool:
+        if self.readers.pop(fd, None) is None:
+            return False
+        try:
+            self.epoll.unregister(fd)
+        except (OSError, ValueError):
+            pass # already closed
+        return True
+
+
+    def set_timer(self, when: float) -> None:
+        '''point the timerfd at when, or turn it off with 0'''
+        sec, nsec = divmod(round(when * 1e9), 1_000_000_000)
+        spec = (ctypes.c_long * 4)(0, 0, sec, nsec) # struct itimerspec: no repeat, then the time to go off
+        self.libc.timerfd_settime(self.timerfd, 1 if when else 0, spec, None) # TFD_TIMER_ABSTIME
+        self.armed = when
+
+
+    def next_timeout(self) -> float:
+        '''seconds epoll should wait, -1 for as long as it takes'''
+        timers = self.timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        when = timers[0][0] if timers else 0.0
+        if self.timerfd >= 0:
+            if when != self.armed:
+                self.set_timer(when)
+            return -1
+        return max(when - self.time(), 0) if timers else -1
+
+
+    def run_timers(self) -> None:
+        timers = self.timers
+        now = self.time()
+        while timers and timers[0][0] <= now:
+            when, booked, timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                self.fired += 1
+                timer.callback(*timer.args)
+
+
+    def run_once(self, timeout: float = -1) -> None:
+        events = self.epoll.poll(timeout)
+        self.wakeups += 1
+        for fd, mask in events:
+            if fd == self.timerfd:
+                try:
+                    os.read(fd, 8) # how many times it went off, we only care that it did
+                except BlockingIOError:
+                    pass
+                self.armed = 0.0
+                continue
+            reader = self.readers.get(fd)
+            if reader:
+                reader[0](*reader[1])
+        self.run_timers()
+
+
+    def run_forever(self) -> None:
+        self.running = True
+        while self.running:
+            self.run_once(self.next_timeout())
+
+
+    def nest(self, loop) -> None:
+        '''run inside another loop (asyncio) by having it watch our epoll fd. needs the timerfd'''
+        loop.add_reader(self.epoll.fileno(), self.run_nested)
+
+
+    def run_nested(self) -> None:
+        self.run_once(0)
+        self.next_timeout() # set the timerfd for whatever's next
+
+
+    def stop(self) -> None:
+        self.running = False
+
+
+    def close(self) -> None:
+        if self.timerfd >= 0:
+            os.close(self.timerfd)
+            self.timerfd = -1
+        self.epoll.close()
+
+
+    def report(self) -> str:
+        timing = "a timerfd" if self.timerfd >= 0 else "epoll timeouts"
+        return f"Event loop woke {self.wakeups} times and ran {self.fired} timers, timed with {timing}."
+
+
+
+class MidiBatch:
+    '''collects the MIDI messages produced by one input frame, drops the ones that would do nothing, and sends the rest in one pass'''
+    def __init__(self) -> None:
+        self.pending: list[list[int]] = []
+        self.sounding: set[ tuple[int, int] ] = set() # (channel, note) pairs we've sent a note-on for
+        self.pending_on: set[ tuple[int, int] ] = set() # note-ons already queued this frame
+        self.output = None # callable taking one message. None means midi_out.send_message
+        self.tee = None # callable taking (time, messages) for every frame sent, for recording
+        self.sent: int = 0
+        self.saved: int = 0
+
+
+    def note_on(self, channel: int, note: int, velocity: int) -> None:
+        if velocity == 0: # a zero velocity note-on is a note-off
+            self.note_off(channel, note)
+            return
+        voice = (channel, note)
+        if voice in self.pending_on: # same note started twice in one frame
+            self.saved += 1
+            return
+        self.pending_on.add(voice)
+        self.sounding.add(voice)
+        self.queue([0x90 | channel, note, velocity])
+
+
+    def note_off(self, channel: int, note: int) -> None:
+        voice = (channel, note)
+        if voice not in self.sounding: # already stopped (or never started)
+            self.saved += 1
+            return
+        self.sounding.discard(voice)
+        self.pending_on.discard(voice)
+        self.queue([0x80 | channel, note, 0])
+
+
+    def control(self, channel: int, control: int, value: int) -> None:
+        if control == 0x78 or control == 0x7B: # all sound off / all notes off
+            self.sounding = { voice for voice in self.sounding if voice[0] != channel }
+            self.pending_on = { voice for voice in self.pending_on if voice[0] != channel }
+        self.queue([0xB0 | channel, control, value])
+
+
+    def queue(self, message: list[int]) -> None:
+        self.pending.append(message)
+        if not BATCH_MIDI:
+            self.flush()
+
+
+    def flush(self) -> int:
+        '''send everything queued this frame. returns how many messages went out'''
+        if not self.pending:
+            return 0
+        send = self.output or midi_out.send_message
+        for message in self.pending:
+            send(message)
+        if self.tee:
+            self.tee( (time.perf_counter(), self.pending) )
+        count = len(self.pending)
+        self.sent += count
+        self.pending = []
+        self.pending_on.clear()
+        return count
+
+
+    def report(self) -> str:
+        total = self.sent + self.saved
+        return f"Sent {self.sent} MIDI messages, skipped {self.saved} redundant ones ({self.saved / max(total, 1):.0%})."
+
+
+
+class PortSink:
+    '''an rtmidi output port'''
+    def __init__(self, port, name: str) -> None:
+        self.port = port
+        self.name = name
+        self.send = port.send_message
+
+
+    def close(self) -> None:
+        self.port.close_port()
+
+
+
+class UdpSink:
+    '''sends each MIDI message as one UDP packet'''
+    def __init__(self, host: str, port: int) -> None:
+        self.name = f"udp {host}:{port}"
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False) # never wait on the network
+        self.address = (host, port)
+        self.dropped: int = 0
+
+
+    def send(self, message: list[int]) -> None:
+        try:
+            self.socket.sendto(bytes(message), self.address)
+        except OSError: # nobody listening, or the buffer is full
+            self.dropped += 1
+
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+
+class NullSink:
+    '''throws everything away, for benchmarking'''
+    def __init__(self) -> None:
+        self.name = "null"
+        self.count: int = 0
+
+
+    def send(self, message: list[int]) -> None:
+        self.count += 1
+
+
+    def close(self) -> None:
+        pass
+
+
+
+def open_sink(spec: dict):
+    '''open one of the OUTPUTS'''
+    kind = spec.get("type")
+    if kind == "virtual":
+        port = rtmidi.MidiOut()
+        port.open_virtual_port(spec["name"])
+        return PortSink(port, spec["name"])
+    if kind == "port":
+        port = rtmidi.MidiOut()
+        names = port.get_ports()
+        for i, name in enumerate(names):
+            if spec["name"].lower() in name.lower():
+                port.open_port(i)
+                return PortSink(port, name)
+        raise RuntimeError(f"No MIDI port matching '{spec['name']}'. There's {', '.join(names) or 'nothing'}")
+    if kind == "udp":
+        return UdpSink(spec.get("host", "127.0.0.1"), spec["port"])
+    if kind == "null":
+        return NullSink()
+    raise ValueError(f"Unknown output type {kind!r} in OUTPUTS")
+
+
+
+def connect(sinks: list) -> tuple:
+    '''one callable that sends to every sink, plus the writer threads behind it. with more than one sink (or MIDI_THREAD)
+    each sink gets its own writer, so a slow one can't hold up the others'''
+    if len(sinks) == 1 and not MIDI_THREAD:
+        return sinks[0].send, []
+    writers = [ MidiWriter(sink.send) for sink in sinks ]
+    if len(writers) == 1:
+        return writers[0].put, writers
+    puts = [ writer.put for writer in writers ]
+    def fan_out(message: list[int]) -> None:
+        for put in puts:
+            put(message)
+    return fan_out, writers
+
+
+
+class ControlThinner:
+    '''sends continuous controllers (CCs and pitch bend) without flooding the port. unchanged values are dropped, each
+    controller sends at most CC_MAX_RATE times a second, and changes under CC_THRESHOLD wait until the controller settles.
+    whatever value a controller ends up on always gets sent, by a timer if no more input comes along. the timer goes on
+    loop (an EventLoop or asyncio loop) when there is one, otherwise on a thread of its own'''
+    def __init__(self, midi: MidiBatch, lock, max_rate: float = CC_MAX_RATE, threshold: int = CC_THRESHOLD) -> None:
+        self.midi = midi
+        self.lock = lock # the player's lock, so the timer thread never sends in the middle of a frame
+        self.interval = 1 / max_rate
+        self.threshold = threshold
+        self.values: dict[ tuple[int, int], int ] = {} # (channel, control) -> last value sent. control -1 is pitch bend
+        self.times: dict[ tuple[int, int], float ] = {} # when it was sent
+        self.pending: dict[ tuple[int, int], tuple[int, float] ] = {} # (value, when it's due) held back for later
+        self.sent: int = 0
+        self.thinned: int = 0
+        self.running: bool = True
+        self.loop = None
+        self.timer = None # the loop timer that sends pending values
+        self.timer_due: float = 0.0
+        self.wake = threading.Event()
+        self.thread = None # only started if there's no loop
+
+
+    def set(self, channel: int, control: int, value: int) -> None:
+        '''a controller moved. call with the player's lock held'''
+        key = (channel, control)
+        last = self.values.get(key)
+        if value == last:
+            self.pending.pop(key, None) # came back to where it was, nothing to send
+            self.thinned += 1
+            return
+        now = time.perf_counter()
+        if last is not None:
+            if now - self.times[key] < self.interval: # too soon, send once the interval is up
+                self.hold(key, value, self.times[key] + self.interval)
+                return
+            if abs(value - last) < self.threshold * (128 if control < 0 else 1): # wobble, send if it settles here
+                self.hold(key, value, now + self.interval)
+                return
+        self.send(key, value, now)
+
+
+    def hold(self, key: tuple[int, int], value: int, due: float) -> None:
+        self.pending[key] = (value, due)
+        self.thinned += 1
+        self.schedule(due)
+
+
+    def schedule(self, due: float) -> None:
+        '''make sure something sends pending values at due'''
+        if self.loop:
+            if self.timer and self.timer_due <= due:
+                return # already booked in time
+            if self.timer:
+                self.timer.cancel()
+            self.timer = self.loop.call_later(max(due - time.perf_counter(), 0), self.fire)
+            self.timer_due = due
+            return
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name="controller timer", daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+
+    def send(self, key: tuple[int, int], value: int, now: float) -> None:
+        channel, control = key
+        if control < 0:
+            self.midi.queue([0xE0 | channel, value & 0x7F, value >> 7])
+        else:
+            self.midi.queue([0xB0 | channel, control, value])
+        self.values[key] = value
+        self.times[key] = now
+        self.pending.pop(key, None)
+        self.sent += 1
+
+
+    def send_due(self) -> float | None:
+        '''send held back values that are due. call with the player's lock held. returns when the next one is due'''
+        now = time.perf_counter()
+        for key, (value, due) in list(self.pending.items()):
+            if due <= now:
+                self.send(key, value, now)
+        self.midi.flush()
+        return min( (due for value, due in self.pending.values()), default=None )
+
+
+    def fire(self) -> None:
+        '''loop timer'''
+        self.timer = None
+        with self.lock:
+            next_due = self.send_due()
+        if next_due is not None and self.running:
+            self.schedule(next_due)
+
+
+    def run(self) -> None:
+        '''timer thread, when there's no loop'''
+        while self.running:
+            self.wake.clear()
+            with self.lock:
+                next_due = self.send_due()
+            self.wake.wait(None if next_due is None else max(next_due - time.perf_counter(), 0))
+
+
+    def close(self) -> None:
+        self.running = False
+        if self.timer:
+            self.timer.cancel()
+        if self.thread:
+            self.wake.set()
+            self.thread.join(timeout=1)
+
+
+    def report(self) -> str:
+        total = self.sent + self.thinned
+        return f"Sent {self.sent} controller messages, thinned out {self.thinned} ({self.thinned / max(total, 1):.0%})."
+
+
+
+class MidiWriter:
+    '''sends MIDI from its own thread. the input thread only drops timestamped messages into a ring buffer.
+    one thread puts, one thread sends, so the ring needs no lock: each side only moves its own index'''
+    def __init__(self, output, size: int = MIDI_QUEUE_SIZE, delay: float = MIDI_SCHEDULE_DELAY) -> None:
+        self.output = output # callable taking one message
+        self.size = size
+        self.ring: list = [None] * size
+        self.head: int = 0 # total messages put, only moved by the input thread
+        self.tail: int = 0 # total messages sent, only moved by the writer thread
+        self.delay = delay
+        self.wake = threading.Event()
+        self.running: bool = True
+        self.dropped: int = 0
+        self.max_depth: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+        self.thread = threading.Thread(target=self.run, name="midi writer", daemon=True)
+        self.thread.start()
+
+
+    def put(self, message: list[int]) -> None:
+        depth = self.head - self.tail
+        if depth >= self.size: # writer has fallen way behind, don't block the input thread
+            self.dropped += 1
+            return
+        self.ring[self.head % self.size] = (time.perf_counter(), message)
+        self.head += 1
+        if depth >= self.max_depth:
+            self.max_depth = depth + 1
+        self.wake.set()
+
+
+    def run(self) -> None:
+        while self.running or self.tail != self.head:
+            self.wake.clear()
+            if self.tail == self.head:
+                self.wake.wait()
+                continue
+            stamp, message = self.ring[self.tail % self.size]
+            self.ring[self.tail % self.size] = None
+            if self.delay:
+                sleep_until(stamp + self.delay)
+            self.output(message)
+            self.tail += 1
+            wait = time.perf_counter() - stamp
+            self.total_wait += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+
+
+    def close(self) -> None:
+        '''send whatever is still queued and stop the thread'''
+        self.running = False
+        self.wake.set()
+        self.thread.join(timeout=1)
+
+
+    def report(self) -> str:
+        average = self.total_wait / max(self.tail, 1)
+        return (f"MIDI thread sent {self.tail} messages, queue depth peaked at {self.max_depth}, "
+            f"dropped {self.dropped}. Queue wait average {average*1000:.3f} ms, max {self.max_wait*1000:.3f} ms.")
+
+
+
+class Clock:
+    '''musical time, ticking 24 times a beat like MIDI clock. either keeps its own tempo on a thread, or follows MIDI clock
+    coming in. every tick's deadline is worked out from the start time, not the last tick, so lateness never adds up into drift.
+    given a loop, ticks are timers on it instead of a thread'''
+    PPQN = 24
+
+    def __init__(self, players: list, tempo: float = TEMPO, follow: bool = MIDI_CLOCK == "follow", loop=None) -> None:
+        self.players = players # everything with clock_tick(tick) and clock_stop()
+        self.tempo = tempo
+        self.follow = follow
+        self.loop = loop
+        self.timer = None
+        self.period: float = 60 / tempo / self.PPQN
+        self.started: float = 0.0
+        self.tick: int = 0
+        self.skipped: int = 0
+        self.running: bool = False
+        self.jitter = LatencyHistogram(width=0.00001) # 10 us buckets, past 5 ms shares the last one
+        self.last_tick: float = 0.0
+        self.interval: float = 0.0 # smoothed time between incoming ticks
+        self.thread = None
+        self.midi_in = None
+
+
+    def start(self) -> None:
+        self.running = True
+        if self.follow:
+            self.midi_in = rtmidi.MidiIn()
+            ports = self.midi_in.get_ports()
+            matches = [ i for i, name in enumerate(ports) if MIDI_CLOCK_INPUT.lower() in name.lower() ]
+            if not matches:
+                raise RuntimeError(f"No MIDI input matching '{MIDI_CLOCK_INPUT}' to follow clock from")
+            self.midi_in.open_port(matches[0])
+            self.midi_in.ignore_types(sysex=True, timing=False, active_sense=True)
+            self.midi_in.set_callback(self.receive)
+            print(f"Following MIDI clock from {ports[matches[0]]}")
+        else:
+            self.started = time.perf_counter()
+            for player in self.players:
+                player.clock_start()
+            if self.loop:
+                self.step()
+            else:
+                self.thread = threading.Thread(target=self.run, name="clock", daemon=True)
+                self.thread.start()
+
+
+    def run(self) -> None:
+        while self.running:
+            deadline = self.started + self.tick * self.period
+            sleep_until(deadline)
+            self.play(deadline)
+        for player in self.players:
+            player.clock_stop()
+
+
+    def step(self) -> None:
+        '''loop timer: play the tick if it's due, then book the next one'''
+        deadline = self.started + self.tick * self.period
+        if time.perf_counter() >= deadline:
+            self.play(deadline)
+            deadline = self.started + self.tick * self.period
+        self.timer = self.loop.call_later(deadline - time.perf_counter(), self.step)
+
+
+    def play(self, deadline: float) -> None:
+        late = time.perf_counter() - deadline
+        if late > self.period: # we got held up for a whole tick or more. skip ahead rather than rush to catch up
+            missed = int(late / self.period)
+            self.tick += missed
+            self.skipped += missed
+            return
+        self.jitter.add(late)
+        for player in self.players:
+            player.clock_tick(self.tick)
+        self.tick += 1
+
+
+    def receive(self, event: tuple, data=None) -> None:
+        '''MIDI input callback, on rtmidi's thread'''
+        message, delta = event
+        status = message[0]
+        if status == 0xF8: # tick
+            now = time.perf_counter()
+            if self.last_tick:
+                gap = now - self.last_tick
+                if self.interval:
+                    self.jitter.add(abs(gap - self.interval))
+                    self.interval += (gap - self.interval) * 0.05
+                else:
+                    self.interval = gap
+            self.last_tick = now
+            for player in self.players:
+                player.clock_tick(self.tick)
+            self.tick += 1
+        elif status == 0xFA: # start
+            self.tick = 0
+            for player in self.players:
+                player.clock_start()
+        elif status == 0xFC: # stop
+            self.last_tick = 0.0
+            for player in self.players:
+                player.clock_stop()
+
+
+    def close(self) -> None:
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        if self.timer:
+            self.timer.cancel()
+            for player in self.players:
+                player.clock_stop()
+        if self.midi_in:
+            self.midi_in.close_port()
+
+
+    def report(self) -> str:
+        jitter = self.jitter
+        if jitter.total:
+            spread = (f"p50 {min(jitter.percentile(0.5), jitter.max)*1e6:.0f} us, p99 {min(jitter.percentile(0.99), jitter.max)*1e6:.0f} us, "
+                f"max {jitter.max*1e6:.0f} us over {jitter.total} ticks")
+        else:
+            spread = "no ticks"
+        if self.follow:
+            tempo = 60 / self.interval / self.PPQN if self.interval else 0
+            return f"Clock followed {self.tick} ticks at about {tempo:.1f} bpm. Tick spacing jitter: {spread}"
+        return f"Clock ran {self.tick} ticks at {self.tempo:g} bpm, skipped {self.skipped}. Lateness: {spread}"
+
+
+
+class EventRecorder:
+    '''writes raw evdev events to a compact file that replay.py can play back without a controller'''
+    MAGIC = b"LCR1"
+    HEADER = struct.Struct("<iB") # trigger depth, device name length
+    EVENT = struct.Struct("<qiHHi") # seconds, microseconds, type, code, value
+
+    def __init__(self, path: str, device_name: str) -> None:
+        name = device_name.encode()[:255]
+        self.file = open(path, "wb")
+        self.file.write(self.MAGIC + self.HEADER.pack(TRIGGER_DEPTH, len(name)) + name)
+        self.count: int = 0
+
+
+    def write(self, event) -> None:
+        self.file.write(self.EVENT.pack(event.sec, event.usec, event.type, event.code, event.value))
+        self.count += 1
+
+
+    def close(self) -> None:
+        self.file.close()
+        print(f"Recorded {self.count} events to {self.file.name}.")
+
+
+
+class NoteState:
+    '''which buttons are holding each MIDI note, as one bitmask per note, plus a sorted list of the notes being held'''
     def __init__(self) -> None:
+        self.owners: list[int] = [0] * 128 # bit n set = button n in BTN_NAMES is holding this note
+        self.active: list[int] = [] # sorted notes with at least one owner
+
+
+    def __contains__(self, note: int) -> bool:
+        return self.owners[note] != 0
+
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+
+    def press(self, note: int, bit: int) -> None:
+        if not self.owners[note]:
+            insort(self.active, note)
+        self.owners[note] |= bit
+
+
+    def release(self, note: int, bit: int) -> bool:
+        '''take one button off a note. True if nothing is holding the note any more'''
+        owners = self.owners[note]
+        if not owners:
+            return True
+        owners &= ~bit
+        self.owners[note] = owners
+        if owners:
+            return False
+        del self.active[ bisect_left(self.active, note) ]
+        return True
+
+
+    def set(self, note: int, owners: int) -> None:
+        '''replace a note's owners outright. 0 forgets the note'''
+        if owners and not self.owners[note]:
+            insort(self.active, note)
+        elif not owners and self.owners[note]:
+            del self.active[ bisect_left(self.active, note) ]
+        self.owners[note] = owners
+
+
+    def replace(self, stopped: tuple[int, ...], held: tuple[ tuple[int, int], ... ]) -> None:
+        '''forget the stopped notes and hold exactly the given (note, owners) pairs, which must be sorted by note'''
+        owners = self.owners
+        for note in stopped:
+            owners[note] = 0
+        for note, bits in held:
+            owners[note] = bits
+        self.active[:] = [ note for note, bits in held ]
+
+
+
+class SaveSlots:
+    '''every save slot is read once at startup and kept in memory, so loading never touches the disk.
+    saving updates memory straight away and a background thread writes the file'''
+    VERSION = 2
+    HEADER = "LoChord save"
+
+    def __init__(self, folder: str = "") -> None:
+        self.folder = folder or SAVE_DIR or os.getcwd()
+        self.slots: dict[str, dict] = {}
+        for slot in [*BTN_NAMES, "default"]:
+            state = self.read(slot)
+            if state:
+                self.slots[slot] = state
+        self.writes: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="save writer", daemon=True)
+        self.thread.start()
+
+
+    def path(self, slot: str) -> str:
+        return os.path.join(self.folder, slot + ".txt")
+
+
+    def read(self, slot: str) -> dict | None:
+        try:
+            with open(self.path(slot)) as file:
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            return None
+        except OSError as error:
+            print(f"Can't read save slot {slot}: {error}")
+            return None
+        try:
+            if lines and lines[0].startswith(self.HEADER):
+                return self.parse(lines)
+            return self.parse_legacy(lines)
+        except (ValueError, IndexError, KeyError) as error:
+            print(f"Save slot {slot} is broken and will be ignored: {error}")
+            return None
+
+
+    def parse(self, lines: list[str]) -> dict:
+        '''current format: a version header, then one "name value" line per setting'''
+        version = int(lines[0][len(self.HEADER):])
+        if version > self.VERSION:
+            raise ValueError(f"made by a newer LoChord (version {version})")
+        fields = {}
+        for line in lines[1:]:
+            if line.strip():
+                name, _, value = line.strip().partition(" ")
+                fields[name] = value.strip()
+        changes = {}
+        for button in BTN_NAMES:
+            octave, inversion = fields.get(button, "0 0").split()
+            changes[button] = [int(octave), int(inversion)]
+        state = {
+            "scale": fields["scale"],
+            "offset": int(fields["offset"]),
+            "changes": changes,
+            "strum": self.parse_bool(fields["strum"]),
+            "guitar": self.parse_bool(fields["guitar"]),
+            "bass": self.parse_bool(fields["bass"]),
+            "note_safe": self.parse_bool(fields["note_safe"]),
+        }
+        self.validate(state)
+        return state
+
+
+    def parse_legacy(self, lines: list[str]) -> dict:
+        '''the original headerless format: scale, offset, one "octave inversion" line per button, then the modes'''
+        lines = lines + [""] * (len(BTN_NAMES) + 6 - len(lines)) # old saves can stop early, missing modes were on
+        changes = {}
+        for i, button in enumerate(BTN_NAMES):
+            octave, inversion = lines[2 + i].split()
+            changes[button] = [int(octave), int(inversion)]
+        modes = [ line.strip().lower() != "false" for line in lines[2 + len(BTN_NAMES):] ]
+        state = {
+            "scale": lines[0].strip(),
+            "offset": int(lines[1]),
+            "changes": changes,
+            "strum": modes[0],
+            "guitar": modes[1],
+            "bass": modes[2],
+            "note_safe": modes[3],
+        }
+        self.validate(state)
+        return state
+
+
+    def parse_bool(self, value: str) -> bool:
+        if value.lower() == "true":
+            return True
+        if value.lower() == "false":
+            return False
+        raise ValueError(f"expected True or False, got {value!r}")
+
+
+    def validate(self, state: dict) -> None:
+        if state["scale"] not in SCALES:
+            raise ValueError(f"unknown scale {state['scale']!r}")
+        if not -60 <= state["offset"] <= 67:
+            raise ValueError(f"offset {state['offset']} is off the keyboard")
+        for button, (octave, inversion) in state["changes"].items():
+            if not 0 <= inversion <= 2 or not -5 <= octave <= 5:
+                raise ValueError(f"{button} has octave {octave} inversion {inversion}")
+
+
+    def format(self, state: dict) -> str:
+        lines = [f"{self.HEADER} {self.VERSION}", f"scale {state['scale']}", f"offset {state['offset']}"]
+        for button, (octave, inversion) in state["changes"].items():
+            lines.append(f"{button} {octave} {inversion}")
+        for name in ("strum", "guitar", "bass", "note_safe"):
+            lines.append(f"{name} {state[name]}")
+        return "\n".join(lines) + "\n"
+
+
+    def get(self, slot: str) -> dict | None:
+        return self.slots.get(slot)
+
+
+    def put(self, slot: str, state: dict) -> None:
+        self.slots[slot] = state
+        self.writes.put( (slot, state) )
+
+
+    def run(self) -> None:
+        '''write saves to disk one at a time. write a temp file then rename it, so a crash never leaves half a save'''
+        while True:
+            slot, state = self.writes.get()
+            if slot is None:
+                return
+            path = self.path(slot)
+            try:
+                with open(path + ".tmp", "w") as file:
+                    file.write(self.format(state))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(path + ".tmp", path)
+            except OSError as error:
+                print(f"Cannot write to file {path}! {error}")
+
+
+    def close(self) -> None:
+        '''finish any saves still waiting to be written'''
+        self.writes.put( (None, None) )
+        self.thread.join(timeout=5)
+
+
+
+class LatencyHistogram:
+    '''counts latencies into fixed 0.1 ms buckets (everything past 50 ms shares the last one), so recording is one increment'''
+    def __init__(self, buckets: int = 500, width: float = 0.0001) -> None:
+        self.width = width
+        self.counts: list[int] = [0] * (buckets + 1)
+        self.total: int = 0
+        self.max: float = 0.0
+
+
+    def add(self, seconds: float) -> None:
+        bucket = int(seconds / self.width)
+        if bucket >= len(self.counts):
+            bucket = len(self.counts) - 1
+        elif bucket < 0: # clocks disagreed, call it instant
+            bucket = 0
+        self.counts[bucket] += 1
+        self.total += 1
+        if seconds > self.max:
+            self.max = seconds
+
+
+    def percentile(self, fraction: float) -> float:
+        '''upper edge of the bucket the given fraction of samples fall under'''
+        target = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return (bucket + 1) * self.width
+        return self.max
+
+
+    def summary(self) -> str:
+        if not self.total:
+            return "no samples"
+        return (f"{self.total} samples, p50 {self.percentile(0.5)*1000:.1f} ms, p95 {self.percentile(0.95)*1000:.1f} ms, "
+            f"p99 {self.percentile(0.99)*1000:.1f} ms, max {self.max*1000:.2f} ms")
+
+
+
+def variable_length(value: int) -> bytes:
+    '''MIDI file variable length number: 7 bits a byte, high bit set on all but the last'''
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | value & 0x7F)
+        value >>= 7
+    return bytes(data)
+
+
+
+class MidiFileRecorder:
+    '''records everything played into a standard MIDI file. the playing side only appends (time, messages) to a deque.
+    a background thread turns them into file events every RECORD_MIDI_FLUSH seconds, so memory stays small and a crash
+    still leaves a playable file'''
+    DIVISION = 960 # ticks per beat
+
+    def __init__(self, path: str, tempo: float = TEMPO) -> None:
+        self.frames: deque = deque() # appends and pops from different threads are safe on a deque
+        self.start = time.perf_counter()
+        self.seconds_per_tick = 60 / tempo / self.DIVISION
+        self.last_tick: int = 0
+        self.count: int = 0
+        self.file = open(path, "wb")
+        self.file.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, self.DIVISION) + b"MTrk" + struct.pack(">I", 0))
+        microseconds = round(60_000_000 / tempo)
+        self.length: int = 0 # bytes in the track so far
+        self.write(b"\x00\xFF\x51\x03" + microseconds.to_bytes(3, "big")) # tempo, so ticks come out as real time
+        self.running: bool = True
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="midi recorder", daemon=True)
+        self.thread.start()
+
+
+    def add(self, frame: tuple[float, list[list[int]]]) -> None:
+        self.frames.append(frame)
+
+
+    def run(self) -> None:
+        while self.running:
+            self.wake.wait(RECORD_MIDI_FLUSH)
+            self.write_frames()
+
+
+    def write_frames(self) -> None:
+        '''encode whatever has been played since last time and put it on disk'''
+        data = bytearray()
+        while self.frames:
+            stamp, messages = self.frames.popleft()
+            tick = max(self.last_tick, round( (stamp - self.start) / self.seconds_per_tick ))
+            for message in messages:
+                if message[0] >= 0xF0:
+                    continue # clock and other system messages don't belong in a track
+                data += variable_length(tick - self.last_tick)
+                data += bytes(message)
+                self.last_tick = tick
+                self.count += 1
+        if data:
+            self.write(data)
+
+
+    def write(self, data: bytes) -> None:
+        self.file.write(data)
+        self.length += len(data)
+        # keep the track length in the header up to date, so the file is readable even if we never get to close it
+        self.file.seek(18)
+        self.file.write(struct.pack(">I", self.length))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+
+    def close(self) -> None:
+        self.running = False
+        self.wake.set()
+        self.thread.join(timeout=5)
+        self.write_frames()
+        self.write(b"\x00\xFF\x2F\x00") # end of track
+        self.file.close()
+        print(f"Recorded {self.count} MIDI messages to {self.file.name}.")
+
+
+
+class MetricsServer:
+    '''serves a JSON snapshot of every player's counters on a unix socket. connect, read until it closes, done.
+    runs on its own thread, or as a reader on loop, and only reads plain counters, so playing never waits on it'''
+    def __init__(self, path: str, players: list, loop=None) -> None:
+        self.path = path
+        self.players = players
+        self.started = time.time()
+        self.last: tuple[float, list[dict[str, int]]] = (time.perf_counter(), [ {} for player in players ])
+        if os.path.exists(path):
+            os.unlink(path) # left over from last time
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(4)
+        self.loop = loop
+        if loop:
+            self.server.setblocking(False)
+            loop.add_reader(self.server.fileno(), self.serve)
+        else:
+            self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+            self.thread.start()
+
+
+    def snapshot(self) -> dict:
+        '''every player's counters, plus events/sec per control since the previous snapshot'''
+        now = time.perf_counter()
+        then, previous = self.last
+        players = []
+        counts = []
+        for player, before in zip(self.players, previous):
+            stats = player.metrics()
+            events = stats["events"]
+            stats["events_per_sec"] = { name: round( (count - before.get(name, 0)) / (now - then), 1 ) for name, count in events.items() }
+            players.append(stats)
+            counts.append(events)
+        self.last = (now, counts)
+        return { "uptime": round(time.time() - self.started, 1), "players": players }
+
+
+    def run(self) -> None:
+        while self.serve():
+            pass
+
+
+    def serve(self) -> bool:
+        '''answer one connection. False once the socket is closed'''
+        try:
+            connection, address = self.server.accept()
+        except BlockingIOError:
+            return True # someone gave up before we got to them
+        except OSError:
+            return False
+        with connection:
+            try:
+                connection.sendall( json.dumps(self.snapshot()).encode() + b"\n" )
+            except OSError:
+                pass # they hung up first
+        return True
+
+
+    def close(self) -> None:
+        if self.loop:
+            self.loop.remove_reader(self.server.fileno())
+        self.server.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+
+def install_profiler(seconds: float = PROFILE_SECONDS) -> None:
+    '''kill -USR2 starts profiling the main thread, and SIGALRM stops it after a while and prints what was hot'''
+    profiler = None
+
+    def start(signum, frame) -> None:
+        nonlocal profiler
+        if profiler:
+            return # already running
+        print(f"Profiling for {seconds:g} seconds...")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+    def stop(signum, frame) -> None:
+        nonlocal profiler
+        if not profiler:
+            return
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats("tottime").print_stats(20)
+        profiler = None
+
+    signal.signal(signal.SIGUSR2, start)
+    signal.signal(signal.SIGALRM, stop)
+
+
+
+class DeviceWatcher:
+    '''calls found(path) for every input event node that shows up or changes permissions in folder. uses inotify, so it
+    sits on loop costing nothing until something's plugged in. linux only'''
+    EVENT = struct.Struct("iIII") # struct inotify_event: watch, mask, cookie, name length. the name follows
+
+    def __init__(self, loop, found, folder: str = "/dev/input") -> None:
+        self.loop = loop
+        self.found = found
+        self.folder = folder
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(0o4000 | 0o2000000) # IN_NONBLOCK | IN_CLOEXEC
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # new nodes come with root-only permissions and udev fixes them a moment later, so watch for both
+        if libc.inotify_add_watch(self.fd, folder.encode(), 0x100 | 0x4) < 0: # IN_CREATE | IN_ATTRIB
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error))
+        loop.add_reader(self.fd, self.read)
+
+
+    def read(self) -> None:
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        names = []
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if name.startswith("event") and name not in names:
+                names.append(name)
+        for name in names:
+            self.found(os.path.join(self.folder, name))
+
+
+    def close(self) -> None:
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+
+class RumblePool:
+    '''rumble effects uploaded once at startup, one per strength level, so strumming only has to write play/stop events. linux only'''
+    def __init__(self, device: InputDevice, levels: int = RUMBLE_LEVELS) -> None:
+        self.device = device
+        self.effects: list[int] = [] # effect ids, weakest first
+        self.playing: int = -1
+        self.plays: int = 0
+        duration_ms = 100
+        for level in range(levels):
+            strength = (level * 128 + 64) // levels # middle of this level's velocity range
+            rumble = ff.Rumble(strong_magnitude=(strength*128), weak_magnitude=(128+strength*384))
+            effect_type = ff.EffectType(ff_rumble_effect=rumble)
+            effect = ff.Effect(
+                ecodes.FF_RUMBLE, -1, 0,
+                ff.Trigger(0, 0),
+                ff.Replay(duration_ms, 0),
+                effect_type
+            )
+            try:
+                self.effects.append(device.upload_effect(effect))
+            except OSError:
+                print("Couldn't upload rumble effects to the controller, rumble is off.")
+                self.close()
+                return
+
+
+    def play(self, strength: int) -> None:
+        if not self.effects:
+            return
+        effect_id = self.effects[ min(strength * len(self.effects) // 128, len(self.effects) - 1) ]
+        if self.playing != -1 and self.playing != effect_id:
+            # stop the last one, otherwise they all play back to back
+            self.device.write(ecodes.EV_FF, self.playing, 0)
+        self.device.write(ecodes.EV_FF, effect_id, 1)
+        self.playing = effect_id
+        self.plays += 1
+
+
+    def close(self) -> None:
+        '''take our effects back off the controller'''
+        for effect_id in self.effects:
+            try:
+                self.device.erase_effect(effect_id)
+            except OSError:
+                pass # controller is already gone
+        self.effects = []
+        self.playing = -1
+
+
+
+class Reconnector:
+    '''keeps one LoChord playing across its controller dropping out. lost() stops the notes and starts watching /dev/input,
+    and the first free controller matching name that turns up is handed to attach(device) and resynced. the LoChord never
+    forgets its key, octaves or modes in between. in_use is shared between players so two can't grab the same controller'''
+    def __init__(self, lc, loop, name: str, in_use: set[str], attach=None) -> None:
+        self.lc = lc
+        self.loop = loop
+        self.name = name
+        self.in_use = in_use # paths of every controller someone's playing
+        self.attach = attach # starts reading a device
+        self.watcher: DeviceWatcher | None = None
+        self.lost_at: float = 0.0
+        self.seen: dict[str, float] = {} # when each node turned up while we were waiting
+
+
+    def lost(self, device: InputDevice) -> None:
+        '''stop the notes straight away, then wait for the controller to come back. stop reading it first'''
+        self.lost_at = time.perf_counter()
+        self.in_use.discard(device.path)
+        lc = self.lc
+        lc.disconnect_linux()
+        if lc.rumble_pool:
+            lc.rumble_pool.close()
+            lc.rumble_pool = None
+        print(f"Lost {device.name}, notes stopped. Waiting for it to come back...")
+        device.close()
+        self.seen.clear()
+        self.watcher = DeviceWatcher(self.loop, self.appeared)
+        for path in list_devices(): # it might have come back before we started watching
+            self.appeared(path)
+
+
+    def appeared(self, path: str) -> None:
+        if not self.watcher or path in self.in_use:
+            return # already back, or someone else's
+        self.seen.setdefault(path, time.perf_counter())
+        try:
+            device = InputDevice(path)
+        except OSError:
+            return # not ours to open yet, we'll hear again when udev sets the permissions
+        if self.name.lower() not in device.name.lower():
+            device.close()
+            return
+        self.close()
+        self.in_use.add(path)
+        lc = self.lc
+        lc.device = device
+        if DO_RUMBLE:
+            lc.rumble_pool = RumblePool(device)
+        self.attach(device)
+        lc.resync_linux() # pick up whatever's already held
+        now = time.perf_counter()
+        lc.reconnects += 1
+        lc.reconnect_time = now - self.lost_at
+        print(f"{device.name} is back ({device.path}). Gone for {lc.reconnect_time:.2f} s, "
+            f"playing again {(now - self.seen[path]) * 1000:.1f} ms after it reappeared.")
+
+
+    def close(self) -> None:
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+
+
+class LoChord:
+    def __init__(self, saves: SaveSlots | None = None) -> None:
         # this section is for variables that change dynamically
         # fucking with scales & chords
         self.main_scale: str = "maj"
@@ -65,7 +1475,11 @@ class LoChord:
 
         # joystick
         self.current_chord: str = "main"
-        self.joystick: list[float] = [ 0.0, 0.0 ]
+        self.joystick: list[int] = [ 0, 0 ] # raw x and y axis values
+        self.stick_sector: int = -1 # index into CHORD_NAMES_CIRCLE, -1 while centered
+        self.stick_angle: list[int] = [] # per table cell: angle in 1/32ths of a chord sector, offset to line up with sector 0
+        self.stick_radius: list[int] = [] # per table cell: distance from center in 1/1024ths
+        self.build_stick_table()
 
         # strum mode
         self.strum_mode: bool = False
@@ -73,41 +1487,111 @@ class LoChord:
         self.strum_clock: float = 0.0
         self.strum_pos: int = 0 # current right trigger position between 0 and TRIGGER_DEPTH
         self.strum_focus: list[str] = ["", ""]
+        self.strum_tables: dict[ int, tuple[ list[int], list[list[int]], list[list[int]] ] ] = {} # by chord size, see strum_table
+        self.strum_tables_depth: int = TRIGGER_DEPTH # calibration the tables were built for
         self.velocity: int = 127
-        self.rumble = 0 # evdev effect id but idk what data type it is
+        self.curves = { **CURVES, **{ name: points_curve(points, name) for name, points in VELOCITY_CURVES.items() } }
+        for curve in (STRUM_CURVE, TRIGGER_CURVE):
+            if curve not in self.curves:
+                raise ValueError(f"Unknown velocity curve '{curve}'. Pick one of {', '.join(self.curves)}")
+        self.strum_curve: str = STRUM_CURVE
+        self.trigger_curve: str = TRIGGER_CURVE
+        self.trigger_velocity: list[int] = [] # velocity for each right trigger position outside strum mode
+        self.rumble_pool: RumblePool | None = None
+        self.rumble: int = -1 # strength to rumble at once this frame's notes are out
         self.unstopped: set[int] = set()
         self.stop_state: int = -1 # for tracking manual note-offs
         self.chord_changed: str | None = None
 
         # general note/button tracking
         self.chords: dict[ str, list[int] ] = {}
+        self.voicings: OrderedDict[ tuple, dict[ str, list[int] ] ] = OrderedDict() # LRU of generated chords
+        self.voicing_state: tuple | None = None # the state self.chords was generated from
+        self.scale_calls: int = 0 # counters for the metrics socket
+        self.scale_builds: int = 0
+        self.frames: int = 0
+        self.event_counts: dict[str, int] = {} # by control name, filled in by build_dispatch
         self.abs_triggers = {
             "ABS_Z": [70, 10, False], # left trigger
             "ABS_RZ": [70, 100, False], # right trigger
         }
         self.pressed_keys: set = set()
-        self.currently_pressed: dict[ int, list[str] ] = {}
+        self.notes = NoteState() # which chord buttons are holding which notes
+        self.button_bits: dict[str, int] = { button: 1 << i for i, button in enumerate(BTN_NAMES) }
+        self.note_targets: list[int] = [0] * 128 # scratch space for change_on_the_fly, always left zeroed
+        self.transitions: OrderedDict = OrderedDict() # (sounding notes, voicing, held buttons, strum mode) -> (offs, ons, held)
+        self.lock = threading.Lock() # held while handling input, so the clock thread never sees a half-applied frame
+        self.send_clock: bool = MIDI_CLOCK == "send"
+        self.arp_step: int = Clock.PPQN // ARP_RATE # clock ticks between arpeggiator notes
+        self.arp_gate: int = max(1, min(self.arp_step, round(self.arp_step * ARP_GATE)))
+        self.arp_index: int = 0
+        self.arp_note: int = -1 # the note the arpeggiator started and has to stop. -1 for none
+        self.arp_off_tick: int = -1
         self.to_stop: set = set()
         self.main_held: bool = False
         self.save_held: bool = False
         self.load_held: bool = False
         self.f13_down: bool = False
+        self.device: InputDevice | None = None # linux controller, for reading state back after SYN_DROPPED
+        self.channel: int = CHANNEL
+        self.buttons_down: set[str] = set() # every button the controller says is held, for resyncing
+        self.frame_keys: list[ tuple[str, bool] ] = [] # button events waiting for SYN_REPORT, in order
+        self.frame_axes: dict[str, int] = {} # latest value of each axis waiting for SYN_REPORT
+        self.frame_dropped: bool = False # kernel dropped events, ignore everything until the next SYN_REPORT
+        self.reconnects: int = 0
+        self.reconnect_time: float = 0.0 # seconds from losing the controller to having it back, last time
         self.trigger: int = 0
         self.run_thread: bool = True
+        self.midi = MidiBatch()
+        self.bass_channel: int = BASS_CHANNEL
+        self.no_bass: list[int] = [0] * 128
+        self.bass_owners: list[int] = self.no_bass # per note, the buttons whose chord has it as the bass mode note, when that has its own channel
+        self.note_channels: list[int] = [-1] * 128 # the channel each sounding note was started on, so it stops on the same one. -1 if not sounding
+        self.controllers = ControlThinner(self.midi, self.lock) if CC_MAP else None
+
+        # latency measurement
+        self.latency: dict[ str, LatencyHistogram ] | None = None
+        if MEASURE_LATENCY:
+            self.latency = { kind: LatencyHistogram() for kind in ("button", "axis", "strum", "chord regen") }
+        self.event_time: float = 0.0 # kernel timestamp of the event being handled
+        self.latency_kind: str = "axis" # which histogram the current event's latency goes in
 
         # this section is constants.
-        self.major = [ 0, 2, 2, 1, 2, 2, 2, 1 ]
-        self.minor = [ 0, 2, 1, 2, 2, 1, 2, 2 ]
-        self.major_tally = []
-        self.minor_tally = []
+        self.vocabulary = Vocabulary(SCALES, SCALE_PARTNERS, CHORDS)
+        for chord in [*CHORD_NAMES_CIRCLE, self.main_chord]:
+            if chord != "main" and chord not in self.vocabulary.shapes:
+                raise ValueError(f"Unknown chord '{chord}'. Pick one of {', '.join(self.vocabulary.shapes)}")
         self.dicts()
-        self.tally()
         self.generate_scale()
+        self.saves = saves or SaveSlots()
         self.f13 = 0x7C
         if WIN:
             self.check_key = ctypes.windll.user32.GetAsyncKeyState
+        else:
+            self.build_dispatch()
         if TRIGGER_DEPTH:
             self.out_of_127 = (TRIGGER_DEPTH+1) / 128
+            self.build_trigger_velocity()
+
+
+    def build_trigger_velocity(self) -> None:
+        curve = self.curves[self.trigger_curve]
+        # clamped to a velocity that's a valid MIDI data byte and still a note-on, whatever the curve does
+        self.trigger_velocity = [ min(max(int(curve( max(127 - value/self.out_of_127, 0) )), 1), 127) for value in range(TRIGGER_DEPTH + 1) ]
+
+
+    def cycle_curve(self, step: int) -> None:
+        '''switch to the next velocity curve for the mode we're in'''
+        names = list(self.curves)
+        if self.strum_mode:
+            self.strum_curve = names[ (names.index(self.strum_curve) + step) % len(names) ]
+            self.strum_tables = {}
+            print(f"Strum velocity curve is now {self.strum_curve}")
+        else:
+            self.trigger_curve = names[ (names.index(self.trigger_curve) + step) % len(names) ]
+            if TRIGGER_DEPTH:
+                self.build_trigger_velocity()
+            print(f"Trigger velocity curve is now {self.trigger_curve}")
 
 
     def dicts(self) -> None:
@@ -115,29 +1599,18 @@ class LoChord:
             self.chords[button] = []
             self.changes[button] = [0,0]
 
-    def tally(self) -> None:
-        note_tally = 0
-        self.major_tally = []
-        for note in self.major:
-            self.major_tally.append(note + note_tally)
-            note_tally += note
-        note_tally = 0
-        self.minor_tally = []
-        for note in self.minor:
-            self.minor_tally.append(note + note_tally)
-            note_tally += note
-
-    def t_f(self, input: str) -> bool:
-        if input.lower() == "false":
-            return False
-        return True
-
-
     def note_on(self, note: int, velocity: int) -> None:
-        midi_out.send_message([0x90 | CHANNEL, note, velocity])
+        channel = self.note_channels[note]
+        if channel < 0: # a note that's still sounding stays on its channel, or its note-off would go to the wrong one
+            # only the bass of a chord that's holding this note goes to the bass channel, not the same pitch in another chord
+            channel = self.bass_channel if self.notes.owners[note] & self.bass_owners[note] else self.channel
+            self.note_channels[note] = channel
+        self.midi.note_on(channel, note, velocity)
 
     def note_off(self, note: int) -> None:
-        midi_out.send_message([0x80 | CHANNEL, note, 0])
+        channel = self.note_channels[note]
+        self.note_channels[note] = -1
+        self.midi.note_off(self.channel if channel < 0 else channel, note)
 
     def all_notes_off(self, force: bool = False) -> None:
         '''stop all currently playing notes'''
@@ -147,27 +1620,18 @@ class LoChord:
         for note in self.unstopped:
             self.note_off(note)
         if force and not WIN:
-            midi_out.send_message([0xB0 | CHANNEL, 0x78, 0]) #cc all notes off
-            midi_out.send_message([0xB0 | CHANNEL, 0x79, 0]) #cc reset all controllers
+            self.midi.control(self.channel, 0x78, 0) #cc all notes off
+            self.midi.control(self.channel, 0x79, 0) #cc reset all controllers
+            if self.bass_channel >= 0 and self.bass_channel != self.channel:
+                self.midi.control(self.bass_channel, 0x78, 0)
+                self.midi.control(self.bass_channel, 0x79, 0)
+            self.note_channels = [-1] * 128
         self.unstopped = set()
 
 
-    def get_step(self, step: int=0, key: str="maj") -> int:
-        if key == "maj":
-            key_tally = self.major_tally
-        elif key == "min":
-            key_tally = self.minor_tally
-        return ( step // 7 * 12 ) + key_tally[ step % 7 ]
-
-
-    def maj_min(self) -> str:
-        if self.main_scale == "maj":
-            return "min"
-        return "maj"
-
-
     def generate_scale(self, key: str = "") -> None:
-        '''define all chords'''
+        '''define all chords, reusing cached voicings when the musical state repeats'''
+        self.scale_calls += 1
         if not key:
             key = self.current_chord
         if key == "main":
@@ -175,209 +1639,176 @@ class LoChord:
         if key == "main":
             key = self.main_scale
 
-        if key == "maj" or key == "min" or key == "maj/min":
-            if key == "maj/min":
-                if self.main_scale == "maj":
-                    key = "min"
-                elif self.main_scale == "min":
-                    key = "maj"
-            for step, chord in enumerate(self.chords):
-                self.chords[chord] = [
-                    60 + self.offset + self.get_step(step  , key),
-                    60 + self.offset + self.get_step(step+2, key),
-                    60 + self.offset + self.get_step(step+4, key),
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + self.get_step(step  , key) + 12)
-                    self.chords[chord].append(60 + self.offset + self.get_step(step+2, key) + 12)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + self.get_step(step  , key) -12)
-
-        elif key == "7":
-            for step, chord in enumerate(self.chords):
-                start = self.get_step(step, self.main_scale)
-                self.chords[chord] = [
-                    60 + self.offset + start,
-                    60 + self.offset + start + 4,
-                    60 + self.offset + start + 7,
-                    60 + self.offset + start + 10,
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + start + 12)
-                    #self.chords[chord].append(60 + self.offset + self.get_step(step+2, key) + 12)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + start -12)
-
-        elif key == "maj/min7": # this probably works for all except dim
-            for step, chord in enumerate(self.chords):
-                self.chords[chord] = [
-                    60 + self.offset + self.get_step(step  , self.main_scale),
-                    60 + self.offset + self.get_step(step+2, self.main_scale),
-                    60 + self.offset + self.get_step(step+4, self.main_scale),
-                    60 + self.offset + self.get_step(step+7, self.main_scale)
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append( 60 + self.offset + self.get_step(step, self.main_scale) + 12 )
-                if self.bass_mode:
-                    self.chords[chord].append( 60 + self.offset + self.get_step(step, self.main_scale) -12 )
-
-        elif key == "maj/min9": # probably all except diminished
-            for step, chord in enumerate(self.chords):
-                self.chords[chord] = [
-                    60 + self.offset + self.get_step(step  , self.main_scale),
-                    60 + self.offset + self.get_step(step+2, self.main_scale),
-                    60 + self.offset + self.get_step(step+4, self.main_scale),
-                    60 + self.offset + 12 + self.get_step(step+2, self.main_scale)
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append( 60 + self.offset + 12 + self.get_step(step+4, self.main_scale) )
-                if self.bass_mode:
-                    self.chords[chord].append( 60 + self.offset + self.get_step(step, self.main_scale) -12 )
-
-        elif key == "sus4":
-            for step, chord in enumerate(self.chords):
-                start = self.get_step(step, self.main_scale)
-                self.chords[chord] = [
-                    60 + self.offset + start,
-                    60 + self.offset + start + 5,
-                    60 + self.offset + start + 7,
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + start + 12)
-                    self.chords[chord].append(60 + self.offset + start + 17)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + start -12 )
-
-        elif key == "sus2":
-            for step, chord in enumerate(self.chords):
-                start = self.get_step(step, self.main_scale)
-                self.chords[chord] = [
-                    60 + self.offset + start,
-                    60 + self.offset + start + 2,
-                    60 + self.offset + start + 7,
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + start + 12)
-                    self.chords[chord].append(60 + self.offset + start + 14)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + start -12 )
-
-        elif key == "dim":
-            for step, chord in enumerate(self.chords):
-                start = self.get_step(step, self.main_scale)
-                self.chords[chord] = [
-                    60 + self.offset + start,
-                    60 + self.offset + start + 3,
-                    60 + self.offset + start + 6,
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + start + 12)
-                    self.chords[chord].append(60 + self.offset + start + 15)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + start -12 )
-
-        elif key == "aug":
-            for step, chord in enumerate(self.chords):
-                start = self.get_step(step, self.main_scale)
-                self.chords[chord] = [
-                    60 + self.offset + start,
-                    60 + self.offset + start + 4,
-                    60 + self.offset + start + 8,
-                ]
-                if self.guitar_mode:
-                    self.chords[chord].append(60 + self.offset + start + 12)
-                    self.chords[chord].append(60 + self.offset + start + 16)
-                if self.bass_mode:
-                    self.chords[chord].append(60 + self.offset + start -12 )
-
-        elif key == "minimal9": # tonic and 9th nothing else
-            for step, chord in enumerate(self.chords):
-                self.chords[chord] = [
-                    60 + self.offset + self.get_step(step  , self.main_scale),
-                    60 + self.offset + 12 + self.get_step(step+2, self.main_scale)
-                ]
-
-        elif key == "perfect5":
-            for step, chord in enumerate(self.chords):
-                self.chords[chord] = [
-                    60 + self.offset + self.get_step(step, self.main_scale),
-                    60 + self.offset + self.get_step(step, self.main_scale) + 7
-                ]
-
-        for key in self.chords: # apply octave/inversion
+        state = (
+            key, self.main_scale, self.offset, self.guitar_mode, self.bass_mode,
+            tuple( (change[0], change[1]) for change in self.changes.values() )
+        )
+        if state == self.voicing_state:
+            return # nothing changed (e.g. d-pad release), so nothing to regenerate
+        self.voicing_state = state
+
+        chords = self.voicings.get(state)
+        if chords is None:
+            self.scale_builds += 1
+            chords = self.build_chords(key)
+            self.voicings[state] = chords
+            if len(self.voicings) > VOICING_CACHE_SIZE:
+                self.voicings.popitem(last=False) # evict least recently used
+        else:
+            self.voicings.move_to_end(state)
+        self.chords = chords
+        if self.bass_channel >= 0 and self.bass_mode and self.vocabulary.shapes[key].get("bass"):
+            bass_owners = [0] * 128
+            for button, chord in chords.items():
+                if chord:
+                    bass_owners[chord[0]] |= self.button_bits[button] # the root an octave down is always lowest
+            self.bass_owners = bass_owners
+        else:
+            self.bass_owners = self.no_bass
+        self.latency_kind = "chord regen"
+        self.change_on_the_fly()
+
+
+    def build_chords(self, key: str) -> dict[ str, list[int] ]:
+        '''work out every chord's notes for a resolved chord type. cached voicings are shared, so never mutate the result'''
+        rows = self.vocabulary.rows[key, self.main_scale, self.guitar_mode, self.bass_mode]
+        tonic = 60 + self.offset
+        chords: dict[ str, list[int] ] = { chord: [ tonic + note for note in row ] for chord, row in zip(BTN_NAMES, rows) }
+
+        for key in chords: # apply octave/inversion
             # octave
             temp = []
-            for note in self.chords[key]:
+            for note in chords[key]:
                 note += 12 * self.changes[key][0]
                 temp.append(note)
-            self.chords[key] = temp
+            chords[key] = temp
 
             # inversions
             if self.changes[key][1] >= 1:
-                self.chords[key][0] += 12
+                chords[key][0] += 12
             if self.changes[key][1] == 2:
-                self.chords[key][1] += 12
-            self.chords[key].sort()
+                chords[key][1] += 12
+            chords[key].sort()
             # inversion: fix overlaps
-            while len(self.chords[key]) != len(set(self.chords[key])):
+            while len(chords[key]) != len(set(chords[key])):
                 temp = []
-                for note in self.chords[key]:
+                for note in chords[key]:
                     if not note in temp:
                         temp.append(note)
                     else:
                         temp.append(note + 12)
                 temp.sort()
-                self.chords[key] = temp
+                chords[key] = temp
+            # anything shifted off either end of the keyboard can't be played
+            if chords[key] and (chords[key][0] < 0 or chords[key][-1] > 127):
+                chords[key] = [ note for note in chords[key] if 0 <= note <= 127 ]
 
-        self.change_on_the_fly()
+        return chords
 
 
 
     def change_on_the_fly(self) -> None:
-        '''change out actively playing chord by doing note-ons/note-offs. TODO: figure out strum integration'''
-        new_notes = set()
-        to_register = []
+        '''change out actively playing chord by doing note-ons/note-offs. notes both chords share are left ringing'''
+        if not self.notes.active and not self.pressed_keys:
+            self.chord_to_strum.clear()
+            return # nothing sounding and nothing to sound
+        key = ( tuple(self.notes.active), self.voicing_state, frozenset(self.pressed_keys), self.strum_mode ) # active is kept sorted
+        transition = self.transitions.get(key)
+        if transition is None:
+            transition = self.transition()
+            self.transitions[key] = transition
+            if len(self.transitions) > TRANSITION_CACHE_SIZE:
+                self.transitions.popitem(last=False) # evict least recently used
+        else:
+            self.transitions.move_to_end(key)
+        offs, ons, held = transition
+        for note in offs:
+            self.note_off(note)
+        self.notes.replace(offs, held) # before the note-ons, so they know which buttons own them
+        for note in ons:
+            self.note_on(note, self.velocity)
+        self.chord_to_strum[:] = self.notes.active
+
+
+    def transition(self) -> tuple[ tuple[int, ...], tuple[int, ...], tuple[ tuple[int, int], ... ] ]:
+        '''work out the smallest change from the notes sounding now to the held buttons' chords:
+        notes to stop, notes to start, and every note that should be held afterwards with who's holding it'''
+        target = self.note_targets
         for key in self.pressed_keys: # all currently pressed keys
+            bit = self.button_bits[key]
             for note in self.chords[key]:
-                new_notes.add(note) # all notes that should be on now
-                to_register.append( [note, key] )
-        remove = []
-        for note in self.currently_pressed:
-            if not note in new_notes:
-                self.note_off(note) # stop all notes that shouldn't be on
-                remove.append(note)
-        for note in remove:
-            del self.currently_pressed[note]
-            while note in self.chord_to_strum:
-                self.chord_to_strum.remove(note)
-        for note in new_notes:
-            if not self.strum_mode:
-                if not note in self.currently_pressed:
-                    self.note_on(note, self.velocity) # start all notes that now should be on
-                else:
-                    if not note in self.chord_to_strum:
-                        self.chord_to_strum.append(note)
-                        self.chord_to_strum.sort()
-        self.chord_to_strum = list(new_notes)
-        self.chord_to_strum.sort()
-        for entry in to_register:
-            self.register( entry[0],entry[1] )
+                target[note] |= bit # all notes that should be on now, and who's holding them
+        notes = self.notes
+        offs = tuple( note for note in notes.active if not target[note] ) # stop all notes that shouldn't be on
+        ons = []
+        held = []
+        for key in self.pressed_keys:
+            for note in self.chords[key]:
+                if not target[note]: # already handled via another button
+                    continue
+                if not self.strum_mode and not note in notes:
+                    ons.append(note) # start all notes that now should be on
+                held.append( (note, target[note]) )
+                target[note] = 0
+        held.sort()
+        ons.sort() # the same however the set of pressed buttons happens to iterate, since that's not part of the cache key
+        return offs, tuple(ons), tuple(held)
+
+
+    def build_stick_table(self) -> None:
+        '''do the trigonometry once for every quantized stick position so interpret_joystick is just a lookup'''
+        size = 1 << STICK_TABLE_BITS
+        self.stick_shift = 16 - STICK_TABLE_BITS
+        cell = (1 << self.stick_shift) / 32768
+        self.stick_angle = [0] * (size * size)
+        self.stick_radius = [0] * (size * size)
+        for i in range(size):
+            x = (i + 0.5) * cell - 1
+            for j in range(size):
+                y = 0 - ((j + 0.5) * cell - 1) # y axis is upside down
+                ang = math.atan2(x, y) / math.pi * 4 + 0.875 # in chord sectors, clockwise from the top
+                self.stick_angle[i << STICK_TABLE_BITS | j] = math.floor(ang * 32) % 256
+                self.stick_radius[i << STICK_TABLE_BITS | j] = int(math.sqrt(x**2 + y**2) * 1024)
+        self.stick_engage = int( (DEADZONE + STICK_RADIUS_HYSTERESIS) * 1024 )
+        self.stick_release = int( (DEADZONE - STICK_RADIUS_HYSTERESIS) * 1024 )
+        self.stick_margin = round(STICK_ANGLE_HYSTERESIS / 45 * 32)
 
 
     def interpret_joystick(self) -> None:
-        '''do trigonometry to change to the right chord'''
-        if math.sqrt(self.joystick[0]**2 + self.joystick[1]**2) < DEADZONE:
+        '''look up which chord the stick points at. hysteresis stops a noisy stick flapping between chords'''
+        x, y = self.joystick
+        if not (-32768 <= x <= 32767 and -32768 <= y <= 32767): # not every controller keeps to 16 bits
+            x = min(max(x, -32768), 32767)
+            y = min(max(y, -32768), 32767)
+        cell = (x + 32768) >> self.stick_shift << STICK_TABLE_BITS | (y + 32768) >> self.stick_shift
+        sector = self.stick_sector
+        if self.stick_radius[cell] < (self.stick_engage if sector < 0 else self.stick_release):
+            sector = -1
             chord = self.main_chord
         else:
-            ang = np.arctan2(self.joystick[0], self.joystick[1]) / math.pi * 4 + 0.875
-            ang = int(ang//1)
-            chord = CHORD_NAMES_CIRCLE[ang]
+            angle = self.stick_angle[cell]
+            # only leave the current sector once the stick is clearly past its edge
+            if sector < 0 or (angle - sector*32 + self.stick_margin) % 256 >= 32 + 2*self.stick_margin:
+                sector = angle >> 5
+            chord = CHORD_NAMES_CIRCLE[sector]
+        self.stick_sector = sector
         if self.current_chord != chord:
             self.current_chord = chord
             self.generate_scale(chord)
 
 
 
+    def prewarm(self) -> None:
+        '''build every chord type the stick can reach and the strum tables for every chord size up front,
+        so the first time something gets played costs the same as the hundredth'''
+        for chord in [*CHORD_NAMES_CIRCLE, "main"]:
+            self.generate_scale(chord)
+        self.generate_scale(self.current_chord)
+        if TRIGGER_DEPTH:
+            for size in range(16): # guitar + bass mode with two chords held is about as big as it gets
+                self.strum_table(size)
+
+
     def play_key( self, key: str ) -> None:
         '''key is pressed, do logic to see what happens'''
         chord = self.chords[key]
@@ -398,20 +1829,28 @@ class LoChord:
             for note in chord:
                 self.unstopped.add(note)
                 self.register(note, key)
-                if not note in self.chord_to_strum:
-                    self.chord_to_strum.append(note)
-            self.chord_to_strum.sort()
+                self.strum_add(note)
 
 
     def register( self, note: int, source: str) -> None:
         '''we keep track of which notes are being played by which keys'''
-        if not note in self.currently_pressed:
-            self.currently_pressed[note] = [source]
-        else:
-            self.currently_pressed[note].append(source)
+        self.notes.press(note, self.button_bits[source])
         self.pressed_keys.add(source)
 
 
+    def strum_add( self, note: int ) -> None:
+        '''put a note into chord_to_strum, keeping it sorted and without doubles'''
+        i = bisect_left(self.chord_to_strum, note)
+        if i == len(self.chord_to_strum) or self.chord_to_strum[i] != note:
+            self.chord_to_strum.insert(i, note)
+
+
+    def strum_remove( self, note: int ) -> None:
+        i = bisect_left(self.chord_to_strum, note)
+        if i != len(self.chord_to_strum) and self.chord_to_strum[i] == note:
+            del self.chord_to_strum[i]
+
+
 
     def release_key( self, key: str, full: bool = True ) -> None:
         '''key is released, do logic to see what happens'''
@@ -421,49 +1860,69 @@ class LoChord:
             return
         for note in chord:
             if self.try_release(note, key):
-                l = []
-                if note in self.chord_to_strum:
-                    l.append(note)
-                for note in l:
-                    self.chord_to_strum.remove(note)
+                self.strum_remove(note)
                 if (key == self.strum_focus[1] or not self.strum_mode) and full:
                     self.note_off(note)
 
 
     def try_release( self, note: int, source: str | None = None ) -> bool:
         '''can we release this note or is something else playing it too?'''
-        try:
-            self.pressed_keys.remove(source)
-        except:
-            pass
-        if note in self.currently_pressed:
-            while source in self.currently_pressed[note]:
-                self.currently_pressed[note].remove(source)
-            if self.currently_pressed[note] == []:
-                del self.currently_pressed[note]
-                return True
-            else:
-                return False
-        else:
-            return True
-        # i also hate this logic.
-
-
-    def try_strum( self, pressure: int, device: InputDevice | None ) -> None:
+        self.pressed_keys.discard(source)
+        return self.notes.release(note, self.button_bits.get(source, 0))
+
+
+    def strum_table( self, size: int = -1 ) -> tuple[ list[int], list[list[int]], list[list[int]] ]:
+        '''strum positions along the trigger for a chord size (the current chord's by default), plus the velocity for every
+        position and trigger movement per frame, on the in and out strokes. only rebuilt when the size, calibration or curve changes'''
+        if size < 0:
+            size = len(self.chord_to_strum)
+        if self.strum_tables_depth != TRIGGER_DEPTH:
+            self.strum_tables = {}
+            self.strum_tables_depth = TRIGGER_DEPTH
+        table = self.strum_tables.get(size)
+        if table is None:
+            sep = (TRIGGER_DEPTH-4) // (size+2)
+            positions = [4] # will break any digital trigger but if your trigger isn't analog you can't strum anyway
+            for i in range(size + 1):
+                # always at least one step past the last one, so a shallow trigger or a huge chord can't put them out of
+                # order (bisect needs them sorted) or stack two strings on one spot
+                positions.append( max(sep*(1+i), positions[-1] + 1) )
+            # the positions on either end of the strum are timing markers to properly measure note velocity
+            weights_in = [ 1 / (1 + STRUM_WEIGHT)**(step/(TRIGGER_DEPTH+1) * 5) for step in positions ]
+            weights_out = [ 1 / (1 - STRUM_WEIGHT)**(step/(TRIGGER_DEPTH+1) * 5) for step in positions ]
+            speeds = self.strum_speeds()
+            velocities_in = [ [ max(int(min(vel * weight, 127)), 1) for vel in speeds ] for weight in weights_in ]
+            velocities_out = [ [ max(int(min(vel * weight, 127)), 1) for vel in speeds ] for weight in weights_out ]
+            table = (positions, velocities_in, velocities_out)
+            self.strum_tables[size] = table
+        return table
+
+
+    def strum_speeds( self ) -> list[float]:
+        '''strum velocity before weighting, for every distance the trigger can move in one frame'''
+        curve = self.curves[self.strum_curve]
+        speeds = []
+        for distance in range(TRIGGER_DEPTH + 1):
+            slope = distance/(1/POLL_RATE)
+            vel = slope/(TRIGGER_DEPTH*0.75)
+            speeds.append( curve(min(vel, 127)) )
+        return speeds
+
+
+    def strum_crossings( self, positions: list[int], low: int, high: int ) -> tuple[int, int]:
+        '''range of note positions the trigger passed over between low and high, leaving out the timing markers'''
+        first = max(bisect_left(positions, low), 1)
+        last = min(bisect_right(positions, high), len(positions) - 1)
+        return first, last
+
+
+    def try_strum( self, pressure: int ) -> None:
         '''process right trigger to strum and rumble the controller'''
-
-        # generate the list of strum positions
-        sep = (TRIGGER_DEPTH-4) // (len(self.chord_to_strum)+2)
-        positions = [4] # will break any digital trigger but if your trigger isn't analog you can't strum anyway
-        for i, note in enumerate(self.chord_to_strum):
-            positions.append( sep*(1+i) )
-        positions.append( sep*(1+len(self.chord_to_strum)) )
-        #print("frame")
-
-        if self.strum_pos < pressure: # if trigger is pushing IN this frame:
-            vel_modifier = 1+ STRUM_WEIGHT
+        pushing = self.strum_pos < pressure # if trigger is pushing IN this frame
+        if pushing:
+            low, high = self.strum_pos, pressure
         else:
-            vel_modifier = 1- STRUM_WEIGHT
+            low, high = pressure, self.strum_pos
 
         # fully press and release trigger with nothing sleected to stop all notes
         if self.pressed_keys: # disqualify
@@ -476,109 +1935,100 @@ class LoChord:
         elif pressure == TRIGGER_DEPTH and self.stop_state == 1:
             self.stop_state = 2
 
-        slope = abs((pressure - self.strum_pos))/(1/POLL_RATE)
-        #print(abs((pressure - self.strum_pos)))
-
-        for i, step in enumerate(positions):
-            if self.strum_pos <= step <= pressure or pressure <= step <= self.strum_pos: # if trigger just passed over a strummable position
-                # the positions on either end of the strum are timing markers to properly measure note velocity
-                if not (i == 0 or i == len(positions)-1):
-                    # only send note offs for the previous chord when the next strum starts
-                    if self.chord_changed:
-                        self.release_key(self.chord_changed)
-                        self.chord_changed = None
-                    # erase rumble effect because if you don't they all queue up back to back
-                    if self.rumble != 0:
-                        device.erase_effect(self.rumble)
-
-                    # calculate velocity
-                    vel = slope/(TRIGGER_DEPTH*0.75)
-                    vel = 127* (1 - ( (1 - ( min( vel, 127) / 127 ))**VELOCITY_SENSITIVITY ) )
-                    step = step/(TRIGGER_DEPTH+1) * 5
-                    vel *= (1 / vel_modifier**(step)) # weigh the strum
-                    vel = int(min(vel, 127))
-
-                    if self.note_safe: # send note off before note on
-                        self.note_off(self.chord_to_strum[i-1])
-                    self.note_on(self.chord_to_strum[i-1], vel)
-                    if not WIN:
-                        self.rumble = self.do_rumble(device, vel)
+        positions, velocities_in, velocities_out = self.strum_table()
+        first, last = self.strum_crossings(positions, low, high)
+        if first < last and self.chord_changed:
+            # only send note offs for the previous chord when the next strum starts
+            self.release_key(self.chord_changed)
+            self.chord_changed = None
+            positions, velocities_in, velocities_out = self.strum_table() # the chord may have shrunk
+            first, last = self.strum_crossings(positions, low, high)
+
+        if first < last:
+            self.latency_kind = "strum"
+            distance = min(high - low, TRIGGER_DEPTH)
+            if pushing:
+                velocities = velocities_in
+                crossed = range(first, last)
+            else: # out-strokes hit the notes top down
+                velocities = velocities_out
+                crossed = range(last - 1, first - 1, -1)
+
+            for i in crossed:
+                note = self.chord_to_strum[i-1]
+                note_vel = velocities[i][distance] # curve and strum weighting, looked up
+                if self.note_safe: # send note off before note on
+                    self.note_off(note)
+                self.note_on(note, note_vel)
+                self.rumble = note_vel
 
         self.strum_pos = pressure
 
 
-    def do_rumble( self, device: InputDevice, strength: int ):
-        '''rumble the controller. returns an effect_id which is a data type i don't know. only works on linux.'''
-        if WIN or not DO_RUMBLE:
-            return 0
-        rumble = ff.Rumble(strong_magnitude=(strength*128), weak_magnitude=(128+strength*384))
-        effect_type = ff.EffectType(ff_rumble_effect=rumble)
-        duration_ms = 100
-
-        effect = ff.Effect(
-            ecodes.FF_RUMBLE, -1, 0,
-            ff.Trigger(0, 0),
-            ff.Replay(duration_ms, 0),
-            effect_type
-        )
-        repeat_count = 1
-        effect_id = device.upload_effect(effect)
-        device.write(ecodes.EV_FF, effect_id, repeat_count)
-        return effect_id
+    def do_rumble( self ) -> None:
+        '''rumble for the last strummed note, after the frame's MIDI is already out. only works on linux.'''
+        if self.rumble == -1:
+            return
+        if self.rumble_pool:
+            self.rumble_pool.play(self.rumble)
+        self.rumble = -1
 
 
 
     def save( self, slot: str ) -> None:
-        '''save current configuration to a text file'''
-        slot += ".txt"
+        '''save current configuration to a slot. the file gets written in the background'''
+        state = {
+            "scale": self.main_scale,
+            "offset": self.offset,
+            "changes": { key: list(change) for key, change in self.changes.items() },
+            "strum": self.strum_mode,
+            "guitar": self.guitar_mode,
+            "bass": self.bass_mode,
+            "note_safe": self.note_safe,
+        }
         try:
-            with open(slot, "w") as file:
-                file.write(self.main_scale + "\n")
-                file.write(str(self.offset) + "\n")
-                for key in self.changes:
-                    file.write(str(self.changes[key][0]) + " ")
-                    file.write(str(self.changes[key][1]) + "\n")
-                file.write(str(self.strum_mode) + "\n")
-                file.write(str(self.guitar_mode) + "\n")
-                file.write(str(self.bass_mode) + "\n")
-                file.write(str(self.note_safe) + "\n")
-            print(f"Saved current config to {slot}.")
-        except PermissionError:
-            print(f"Cannot write to file {slot}!")
+            self.saves.validate(state) # same rules as loading, or it'd be thrown away next time
+        except ValueError as error:
+            print(f"Can't save to {slot}: {error}. Bring it back toward middle C and try again.")
+            print()
+            return
+        self.saves.put(slot, state)
+        print(f"Saved current config to {slot}.")
         print()
 
 
     def load( self, slot: str ) -> None:
-        '''load configuration from text file. NOT RESILIENT!!!!!!!!!!!!!!! NO error handling yet'''
-        slot += ".txt"
-        try:
-            with open(slot) as file:
-                self.main_scale = file.readline().strip()
-                self.offset = int(file.readline().strip())
-                for key in self.changes:
-                    temp = file.readline().strip().split(" ")
-                    temp[0] = int(temp[0])
-                    temp[1] = int(temp[1])
-                    self.changes[key] = temp
-                self.strum_mode = self.t_f(file.readline().strip())
-                if not self.strum_mode:
-                    self.all_notes_off()
-                self.guitar_mode = self.t_f(file.readline().strip())
-                self.bass_mode = self.t_f(file.readline().strip())
-                self.note_safe = self.t_f(file.readline().strip())
+        '''load configuration from a slot. it's already in memory, so this is instant'''
+        state = self.saves.get(slot)
+        if state is None:
+            print(f"No save file in slot {slot}.")
+        else:
+            self.main_scale = state["scale"]
+            self.offset = state["offset"]
+            for key in self.changes:
+                self.changes[key] = list(state["changes"][key])
+            self.strum_mode = state["strum"]
+            if not self.strum_mode:
+                self.all_notes_off()
+            self.guitar_mode = state["guitar"]
+            self.bass_mode = state["bass"]
+            self.note_safe = state["note_safe"]
             print(f"Loaded config from {slot}.")
             print(f"Strum mode is {self.strum_mode}")
             print(f"Guitar mode is {self.guitar_mode}")
             print(f"Bass mode is {self.bass_mode}")
             print(f"Note-safe mode is {self.note_safe}")
-        except FileNotFoundError:
-            print(f"No save file in slot {slot}.")
         self.generate_scale()
         print()
 
 
 
     def process_button(self, button: str, down: bool):
+        if down:
+            self.buttons_down.add(button)
+        else:
+            self.buttons_down.discard(button)
+
         if button == "BTN_MODE":
             if down:
                 self.main_held = True
@@ -617,7 +2067,23 @@ class LoChord:
 
 
 
+    def send_controller(self, code: str, value: int) -> None:
+        '''turn an axis position into the CC or pitch bend CC_MAP gives it'''
+        target = CC_MAP[code]
+        bend = target == "pitchbend"
+        if code == "ABS_Z" or code == "ABS_RZ": # triggers rest at 0. pitch bend goes up from the middle
+            travel = min(value, TRIGGER_DEPTH) / max(TRIGGER_DEPTH, 1)
+            scaled = 8192 + int(travel * 8191) if bend else int(travel * 127)
+        else: # sticks are signed 16 bit, centred on 0
+            if code.endswith("Y"):
+                value = -1 - value # up is negative
+            scaled = (value + 32768) >> 2 if bend else (value + 32768) >> 9
+        self.controllers.set(self.channel, -1 if bend else int(target), scaled)
+
+
     def process_axis(self, code: str, value: int) -> None:
+        if code in CC_MAP:
+            self.send_controller(code, value)
         if code == "ABS_RZ": # velocity & strum
             note, threshold, active = self.abs_triggers[code]
             if TRIGGER_DEPTH == 0:
@@ -625,7 +2091,7 @@ class LoChord:
                 if value == 0:
                     print(f"Set your trigger depth value to {self.trigger}.")
             elif not self.strum_mode and not self.main_held and not self.load_held:
-                self.velocity = int( 127 - value/self.out_of_127 )
+                self.velocity = self.trigger_velocity[ min(value, TRIGGER_DEPTH) ]
             elif not self.pressed_keys:
                 if self.main_held:
                     if not active and value > threshold:
@@ -646,9 +2112,9 @@ class LoChord:
                     elif active and value <= threshold:
                         self.abs_triggers[code][2] = False
                 else:
-                    self.try_strum(value, device)
+                    self.try_strum(value)
             else:
-                self.try_strum(value, device)
+                self.try_strum(value)
 
         elif code in self.abs_triggers: # the 7th scale degree is played by the left trigger
             note, threshold, active = self.abs_triggers[code]
@@ -668,12 +2134,14 @@ class LoChord:
 
         elif code == "ABS_X" or code == "ABS_Y": # process joystick values
             if code == "ABS_X":
-                self.joystick[0] = value / 32768
+                self.joystick[0] = value
             elif code == "ABS_Y":
-                self.joystick[1] = 0 - (value / 32768)
+                self.joystick[1] = value
             self.interpret_joystick()
 
         elif code == "ABS_HAT0X": # change key
+            if value == 0: # d-pad released, nothing to do
+                return
             if self.main_held:
                 if value == 1:
                     self.guitar_mode = not self.guitar_mode
@@ -681,13 +2149,18 @@ class LoChord:
                 elif value == -1:
                     self.bass_mode = not self.bass_mode
                     print(f"Bass mode is now {self.bass_mode}")
+            elif self.save_held:
+                self.cycle_curve(value)
+                return
             else:
                 self.offset += value
             self.generate_scale()
 
         elif code == "ABS_HAT0Y":
+            if value == 0:
+                return
             if self.main_held and value != 0: # swap main scale
-                self.main_scale = self.maj_min()
+                self.main_scale = self.vocabulary.next_scale(self.main_scale, -value)
                 self.current_chord = "main"
             elif self.pressed_keys and value != 0: # octave for selected chords
                 for key in self.pressed_keys:
@@ -703,52 +2176,278 @@ class LoChord:
 
 
 
+    def build_dispatch(self) -> None:
+        '''work out once which raw evdev codes are controls we use and what we call them, so handling an event is a dict
+        lookup instead of categorize() and name matching. CONTROL_MAP gets applied here, so remapping is just data'''
+        wanted = {*BTN_NAMES, "BTN_MODE", "BTN_SELECT", "BTN_START", "ABS_X", "ABS_Y", "ABS_RZ", "ABS_HAT0X", "ABS_HAT0Y", *CC_MAP}
+        self.dispatch: dict[int, dict[int, str]] = {} # event type -> event code -> control name
+        for type, codes in ( (ecodes.EV_KEY, ecodes.keys), (ecodes.EV_ABS, ecodes.ABS) ):
+            names = {}
+            for code, name in codes.items():
+                if isinstance(name, (list, tuple)): # codes with several names, like ("BTN_A", "BTN_GAMEPAD", "BTN_SOUTH"). older evdev gives a list
+                    name = next( (n for n in ("BTN_A", "BTN_X", "BTN_Y", "BTN_B") if n in name), name[0] )
+                name = CONTROL_MAP.get(name, name)
+                if name in wanted:
+                    names[code] = name
+            self.dispatch[type] = names
+        self.key_codes = self.dispatch[ecodes.EV_KEY]
+        self.axis_codes = self.dispatch[ecodes.EV_ABS]
+        self.event_counts = { name: 0 for names in self.dispatch.values() for name in names.values() }
+
+
     def process_frame_linux(self, event) -> None:
         '''does all the heavy lifting'''
-        if event.type == ecodes.EV_KEY:
-            key = categorize(event)
-            button = key.keycode
-
-            if isinstance(button, list):
-                if "BTN_A" in button:
-                    button = "BTN_A"
-                elif "BTN_X" in button:
-                    button = "BTN_X"
-                elif "BTN_Y" in button:
-                    button = "BTN_Y"
-                elif "BTN_B" in button:
-                    button = "BTN_B"
-                else:
-                    button = button[0]
-            down = key.keystate == key.key_down
-            self.process_button(button, down)
+        if self.latency is not None:
+            self.event_time = event.timestamp()
+        with self.lock:
+            if event.type == ecodes.EV_KEY:
+                button = self.key_codes.get(event.code)
+                if button and event.value != 2: # 2 is key repeat
+                    self.event_counts[button] += 1
+                    self.latency_kind = "button"
+                    self.process_button(button, event.value == 1)
+
+            elif event.type == ecodes.EV_ABS:
+                axis = self.axis_codes.get(event.code)
+                if axis:
+                    self.event_counts[axis] += 1
+                    self.latency_kind = "axis"
+                    self.process_axis(axis, event.value)
+            self.finish_frame()
+
+
+    def finish_frame(self) -> None:
+        '''everything that happens once the input is handled: notes first, then the slow stuff'''
+        sent = self.midi.flush()
+        self.frames += 1
+        if sent and self.latency is not None:
+            # evdev timestamps come from the realtime clock, same as time.time()
+            self.latency[self.latency_kind].add(time.time() - self.event_time)
+        self.do_rumble()
+        self.strum_clock = time.perf_counter()
 
+
+    def clock_start(self) -> None:
+        with self.lock:
+            if self.send_clock:
+                self.midi.queue([0xFA])
+            self.arp_index = 0
+            self.midi.flush()
+
+
+    def clock_tick(self, tick: int) -> None:
+        '''called by the clock 24 times a beat, from the clock's thread'''
+        with self.lock:
+            if self.send_clock:
+                self.midi.queue([0xF8])
+            if tick == self.arp_off_tick:
+                self.arp_release()
+            if ARPEGGIATOR and self.strum_mode and tick % self.arp_step == 0:
+                self.arp_release()
+                self.arp_play(tick)
+            self.midi.flush()
+
+
+    def clock_stop(self) -> None:
+        with self.lock:
+            self.arp_release()
+            if self.send_clock:
+                self.midi.queue([0xFC])
+            self.midi.flush()
+
+
+    def arp_play(self, tick: int) -> None:
+        '''start the next note of the held chord'''
+        notes = self.chord_to_strum
+        count = len(notes)
+        if not count:
+            self.arp_index = 0
+            return
+        step = self.arp_index
+        self.arp_index += 1
+        if ARPEGGIATOR == "down":
+            note = notes[-1 - step % count]
+        elif ARPEGGIATOR == "updown" and count > 1:
+            step %= 2 * count - 2
+            note = notes[step] if step < count else notes[2 * count - 2 - step]
+        else:
+            note = notes[step % count]
+        if self.note_channels[note] >= 0:
+            return # already ringing from a strum. leave it to the strum to stop
+        self.note_on(note, self.velocity)
+        self.arp_note = note
+        self.arp_off_tick = tick + self.arp_gate
+
+
+    def arp_release(self) -> None:
+        if self.arp_note >= 0:
+            self.note_off(self.arp_note)
+            self.arp_note = -1
+            self.arp_off_tick = -1
+
+
+    def metrics(self) -> dict:
+        '''plain counters for the metrics socket. read from another thread, so nothing here changes any state'''
+        return {
+            "channel": self.channel + 1,
+            "events": dict(self.event_counts),
+            "frames": self.frames,
+            "generate_scale_calls": self.scale_calls,
+            "chord_builds": self.scale_builds,
+            "midi_sent": self.midi.sent,
+            "midi_skipped": self.midi.saved,
+            "rumble_uploads": len(self.rumble_pool.effects) if self.rumble_pool else 0,
+            "rumble_plays": self.rumble_pool.plays if self.rumble_pool else 0,
+            "notes_held": len(self.notes),
+            "notes_unstopped": len(self.unstopped),
+            "strum_mode": self.strum_mode,
+            "reconnects": self.reconnects,
+            "reconnect_ms": round(self.reconnect_time * 1000, 1),
+        }
+
+
+    def latency_report(self) -> str:
+        if self.latency is None:
+            return "Latency measurement is off (MEASURE_LATENCY)."
+        lines = ["Controller event to MIDI out latency:"]
+        for kind, histogram in self.latency.items():
+            lines.append(f"  {kind}: {histogram.summary()}")
+        return "\n".join(lines)
+
+
+    def queue_event_linux(self, event) -> None:
+        '''collect events until SYN_REPORT so each controller frame is applied once'''
+        if event.type == ecodes.EV_SYN:
+            if event.code == ecodes.SYN_REPORT:
+                if self.latency is not None:
+                    self.event_time = event.timestamp()
+                    self.latency_kind = "button" if self.frame_keys else "axis"
+                if self.frame_dropped:
+                    self.frame_dropped = False
+                    self.resync_linux()
+                else:
+                    self.apply_frame_linux()
+            elif event.code == ecodes.SYN_DROPPED:
+                # the kernel buffer overflowed. everything up to the next SYN_REPORT is incomplete
+                self.frame_keys = []
+                self.frame_axes = {}
+                self.frame_dropped = True
+        elif self.frame_dropped:
+            return
+        elif event.type == ecodes.EV_KEY:
+            button = self.key_codes.get(event.code)
+            if button and event.value != 2: # 2 is key repeat
+                self.event_counts[button] += 1
+                self.frame_keys.append( (button, event.value == 1) )
         elif event.type == ecodes.EV_ABS:
-            code = ecodes.ABS[event.code] if event.code in ecodes.ABS else None
-            self.process_axis(code, event.value)
-        self.strum_clock = time.perf_counter()
+            axis = self.axis_codes.get(event.code)
+            if axis:
+                self.event_counts[axis] += 1
+                self.frame_axes[axis] = event.value # only the latest value matters
+
+
+    def apply_frame_linux(self) -> None:
+        '''apply one frame: stick and d-pad first so buttons pressed in the same frame get the new chord, then buttons, then triggers'''
+        axes = self.frame_axes
+        keys = self.frame_keys
+        self.frame_axes = {}
+        self.frame_keys = []
+        with self.lock:
+            stick_x = axes.pop("ABS_X", None)
+            stick_y = axes.pop("ABS_Y", None)
+            if stick_x is not None or stick_y is not None:
+                # both halves of the stick vector before working out the chord, so it's only done once
+                if stick_x is not None:
+                    self.joystick[0] = stick_x
+                    if "ABS_X" in CC_MAP:
+                        self.send_controller("ABS_X", stick_x)
+                if stick_y is not None:
+                    self.joystick[1] = stick_y
+                    if "ABS_Y" in CC_MAP:
+                        self.send_controller("ABS_Y", stick_y)
+                self.interpret_joystick()
+            for axis in ("ABS_HAT0X", "ABS_HAT0Y"):
+                if axis in axes:
+                    self.process_axis(axis, axes.pop(axis))
+
+            for button, down in keys:
+                self.process_button(button, down)
+
+            for axis, value in axes.items():
+                self.process_axis(axis, value)
+
+            self.finish_frame()
+
+
+    def disconnect_linux(self) -> None:
+        '''the controller's gone. stop everything it was playing and let go of everything it was holding, but keep the
+        key, octaves, inversions and modes for when it comes back'''
+        with self.lock:
+            self.unstopped.update(self.notes.active)
+            self.all_notes_off(True)
+            for note in list(self.notes.active):
+                self.notes.set(note, 0)
+            self.buttons_down = set()
+            self.main_held = self.save_held = self.load_held = False
+            self.chord_changed = None
+            self.strum_pos = 0
+            for trigger in self.abs_triggers.values():
+                trigger[2] = False # so a trigger still held when it comes back counts as a fresh press
+            self.rumble = -1
+            self.frame_keys = []
+            self.frame_axes = {}
+            self.frame_dropped = False
+            self.midi.flush()
+
+
+    def resync_linux(self) -> None:
+        '''after SYN_DROPPED, read the real button and axis state from the device and catch up with it'''
+        if self.device is None: # a replay, with no controller to ask. trust the events that follow
+            self.apply_frame_linux()
+            return
+        active = set(self.device.active_keys())
+        held = { button for code, button in self.key_codes.items() if code in active }
+        for button in [*BTN_NAMES, "BTN_MODE", "BTN_SELECT", "BTN_START"]:
+            down = button in held
+            if down != (button in self.buttons_down):
+                self.frame_keys.append( (button, down) )
+        # d-pad presses are one-shot key/octave changes so there's no state to catch up on
+        for code, axis in self.axis_codes.items():
+            if axis not in ("ABS_X", "ABS_Y", "ABS_Z", "ABS_RZ"):
+                continue
+            value = self.device.absinfo(code).value
+            if axis == "ABS_RZ":
+                self.strum_pos = value # pick the trigger up where it is rather than strumming up to it
+            self.frame_axes[axis] = value
+        self.apply_frame_linux()
 
 
     def check_f13_thread(self) -> None:
         while threading.main_thread().is_alive():
             if self.check_key(self.f13):
                 if not self.f13_down:
-                    self.process_button("BTN_MODE", True)
+                    with self.lock:
+                        self.process_button("BTN_MODE", True)
+                        self.midi.flush()
                     self.f13_down = True
             else:
                 if self.f13_down:
-                    self.process_button("BTN_MODE", False)
+                    with self.lock:
+                        self.process_button("BTN_MODE", False)
+                        self.midi.flush()
                     self.f13_down = False
             time.sleep(0.003)
 
 
     def process_frame_windows(self) -> None:
         events = gamepad.read()
-        for e in events:
-            if e.ev_type == "Key":
-                self.process_button(e.code, e.state)
-            elif e.ev_type == "Absolute":
-                self.process_axis(e.code, e.state)
+        with self.lock:
+            for e in events:
+                if e.ev_type == "Key":
+                    self.process_button(e.code, e.state)
+                elif e.ev_type == "Absolute":
+                    self.process_axis(e.code, e.state)
+            self.midi.flush()
         time.sleep(0.001)
 
 
@@ -789,12 +2488,223 @@ class LoChord:
 
 
 
+def start_clock(players: list[LoChord], loop: EventLoop | None = None) -> Clock | None:
+    '''start the clock if anything needs musical time'''
+    if not ARPEGGIATOR and not MIDI_CLOCK:
+        return None
+    clock = Clock(players, TEMPO, MIDI_CLOCK == "follow", loop)
+    clock.start()
+    if not clock.follow:
+        print(f"Clock running at {clock.tempo:g} bpm" + (", sending MIDI clock" if MIDI_CLOCK == "send" else ""))
+    return clock
+
+
+
+def embedded_setup() -> None:
+    '''set the process up for steady latency on a dedicated box. anything we're not allowed to do gets skipped with a note.
+    policy and affinity are per thread and only passed on to threads started afterwards, so this runs before any of ours start'''
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RT_PRIORITY))
+        print(f"Real-time priority {RT_PRIORITY}.")
+    except OSError as error:
+        print(f"No real-time priority ({error.strerror}). Try sudo or an rtprio limit for your user.")
+        try:
+            os.nice(-10)
+        except PermissionError:
+            pass
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[RT_CPU] if -len(cpus) <= RT_CPU < len(cpus) else cpus[-1]
+    try:
+        os.sched_setaffinity(0, {cpu})
+        print(f"Pinned to CPU {cpu}.")
+    except OSError as error:
+        print(f"Couldn't pin to CPU {cpu} ({error.strerror}).")
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(1 | 2) != 0: # MCL_CURRENT | MCL_FUTURE
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        print("Memory locked.")
+    except (OSError, AttributeError) as error:
+        print(f"Couldn't lock memory ({getattr(error, 'strerror', error)}). Raise the memlock limit to stop page faults mid-song.")
+
+
+def embedded_ready(players: list[LoChord]) -> None:
+    '''build everything ahead of the first note and get the garbage collector out of the way, then say how startup went'''
+    for lc in players:
+        lc.prewarm()
+    # everything built so far lives for the whole run. freeze it so the collector never walks it again, then make it
+    # wait much longer between passes. LoChord makes next to no reference cycles, so the rare pass has little to walk
+    gc.collect()
+    gc.freeze()
+    gc.set_threshold(GC_THRESHOLD, 50, 100)
+
+    rss = "unknown"
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    rss = f"{int(line.split()[1]) / 1024:.1f} MB"
+    except OSError:
+        pass
+    print(f"Ready in {time.perf_counter() - STARTED:.2f} s, using {rss} of memory.")
+
+
+
+async def play_controller(lc: LoChord, device: InputDevice, counts: list[int], player: int, link: Reconnector) -> None:
+    '''feed one controller's events to its LoChord as they arrive, and wait for it to come back if it drops out'''
+    while True:
+        try:
+            async for event in device.async_read_loop():
+                counts[player] += 1
+                if COALESCE_FRAMES:
+                    lc.queue_event_linux(event)
+                else:
+                    lc.process_frame_linux(event)
+        except OSError: # unplugged or out of range
+            print(f"Player {player+1}: ", end="")
+            back = asyncio.get_running_loop().create_future()
+            link.attach = back.set_result
+            link.lost(device)
+            device = await back
+
+
+async def report_rates(counts: list[int]) -> None:
+    '''print events/sec per controller, and how late the event loop wakes up, to see how it copes with more players'''
+    last = list(counts)
+    while True:
+        before = time.perf_counter()
+        await asyncio.sleep(RATE_REPORT_INTERVAL)
+        elapsed = time.perf_counter() - before
+        rates = [ (count - previous) / elapsed for count, previous in zip(counts, last) ]
+        last = list(counts)
+        players = ", ".join( f"player {n+1} {rate:.0f}/s" for n, rate in enumerate(rates) )
+        print(f"Events: {players}, total {sum(rates):.0f}/s. Loop woke {(elapsed - RATE_REPORT_INTERVAL)*1000:.2f} ms late.")
+
+
+async def main_multi() -> None:
+    '''one asyncio loop serving every matching controller, each with its own LoChord and channel or port'''
+    global midi_out
+    devices = []
+    for path in list_devices():
+        dev = InputDevice(path)
+        if CONTROLLER_NAME.lower() in dev.name.lower():
+            devices.append(dev)
+        else:
+            dev.close()
+    if not devices:
+        raise RuntimeError(f"Controller '{CONTROLLER_NAME}' not found")
+
+    midi_out = rtmidi.MidiOut()
+    midi_out.open_virtual_port(MIDI_PORT_NAME)
+    ports = [ PortSink(midi_out, MIDI_PORT_NAME) ]
+    extras = [ open_sink(spec) for spec in OUTPUTS ] # everyone is sent to these too
+    players: list[LoChord] = []
+    writers: list[MidiWriter] = []
+    saves = SaveSlots() # every player shares the same slots
+    song = MidiFileRecorder(RECORD_MIDI) if RECORD_MIDI else None # and everyone goes in the one recording
+    for n, dev in enumerate(devices):
+        lc = LoChord(saves)
+        lc.device = dev
+        if MULTI_CONTROLLER_OUTPUT == "port":
+            if n:
+                ports.append( open_sink({"type": "virtual", "name": f"{MIDI_PORT_NAME} {n+1}"}) )
+            port = ports[n]
+            where = f"port {port.name}"
+        else:
+            lc.channel = (CHANNEL + n) % 16
+            lc.send_clock = lc.send_clock and n == 0 # everyone shares the port, so only one clock
+            port = ports[0]
+            where = f"channel {lc.channel + 1}"
+        output, player_writers = connect([port, *extras])
+        writers += player_writers
+        lc.midi.output = output
+        if song:
+            lc.midi.tee = song.add
+        if DO_RUMBLE:
+            lc.rumble_pool = RumblePool(dev)
+        players.append(lc)
+        print(f"Player {n+1}: {dev.name} ({dev.path}) on {where}")
+
+    if MEASURE_LATENCY:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print( "\n".join(lc.latency_report() for lc in players) ))
+    install_profiler()
+    loop = asyncio.get_running_loop()
+    for lc in players:
+        if lc.controllers:
+            lc.controllers.loop = loop
+    metrics = MetricsServer(METRICS_SOCKET, players, loop) if METRICS_SOCKET else None
+    # asyncio only wakes to the millisecond, so the clock gets a timerfd of its own, watched by the asyncio loop
+    timers = EventLoop()
+    if timers.timerfd >= 0:
+        timers.nest(loop)
+    clock = start_clock(players, timers if timers.timerfd >= 0 else None)
+    if EMBEDDED:
+        embedded_ready(players)
+    print("Listening for gamepad button presses...")
+    if TRIGGER_DEPTH == 0:
+        print("Fully press and release your right trigger.")
+
+    counts = [0] * len(players)
+    in_use = { dev.path for dev in devices }
+    links = [ Reconnector(lc, loop, CONTROLLER_NAME, in_use) for lc in players ]
+    tasks = [ play_controller(lc, dev, counts, n, links[n]) for n, (lc, dev) in enumerate(zip(players, devices)) ]
+    if RATE_REPORT_INTERVAL:
+        tasks.append( report_rates(counts) )
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if clock:
+            clock.close()
+            print(clock.report())
+        if timers.timerfd >= 0:
+            loop.remove_reader(timers.epoll.fileno())
+        timers.close()
+        for link in links:
+            link.close()
+        if song:
+            song.close()
+        if metrics:
+            metrics.close()
+        for n, lc in enumerate(players):
+            print(f"Player {n+1}: {lc.midi.report()}")
+            if lc.controllers:
+                lc.controllers.close()
+                print(lc.controllers.report())
+            if MEASURE_LATENCY:
+                print(lc.latency_report())
+            if lc.rumble_pool:
+                lc.rumble_pool.close()
+        for writer in writers:
+            writer.close()
+            print(writer.report())
+        for sink in ports[1:] + extras:
+            sink.close()
+        saves.close()
+
+
+
 def main():
+    if EMBEDDED and not WIN:
+        embedded_setup() # before the writer, save and recording threads start, so they get it too
+    if MULTI_CONTROLLER and not WIN:
+        try:
+            asyncio.run(main_multi())
+        except KeyboardInterrupt:
+            print("\rExiting")
+        return
+
     lc = LoChord()
     global midi_out
     midi_out = rtmidi.MidiOut()
     global device
     device = None
+    extras = [ open_sink(spec) for spec in OUTPUTS ]
+    output, writers = connect([ PortSink(midi_out, MIDI_PORT_NAME), *extras ])
+    lc.midi.output = output
+    song = None
+    if RECORD_MIDI:
+        song = MidiFileRecorder(RECORD_MIDI)
+        lc.midi.tee = song.add
 
 
     if not WIN:
@@ -806,18 +2716,82 @@ def main():
         if not device:
             raise RuntimeError(f"Controller '{CONTROLLER_NAME}' not found")
         print(f"Using controller: {device.name} ({device.path})")
+        lc.device = device
+        if DO_RUMBLE:
+            lc.rumble_pool = RumblePool(device)
 
         midi_out.open_virtual_port(MIDI_PORT_NAME)
+        if MEASURE_LATENCY:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: print(lc.latency_report()))
+        install_profiler()
+        loop = EventLoop()
+        if lc.controllers:
+            lc.controllers.loop = loop
+        metrics = MetricsServer(METRICS_SOCKET, [lc], loop) if METRICS_SOCKET else None
+        recorder = None
+        if RECORD_EVENTS:
+            recorder = EventRecorder(RECORD_EVENTS, device.name)
+        handle = lc.queue_event_linux if COALESCE_FRAMES else lc.process_frame_linux
+
+        def attach(dev: InputDevice) -> None:
+            global device
+            device = dev
+            loop.add_reader(dev.fd, read_controller)
+
+        link = Reconnector(lc, loop, CONTROLLER_NAME, {device.path}, attach)
+
+        def read_controller() -> None:
+            try:
+                events = device.read()
+                for event in events:
+                    if recorder:
+                        recorder.write(event)
+                    handle(event)
+            except BlockingIOError:
+                pass # woken for nothing
+            except OSError: # unplugged, out of range, flat battery
+                loop.remove_reader(device.fd)
+                link.lost(device)
+
+        loop.add_reader(device.fd, read_controller)
+        clock = start_clock([lc], loop)
+        if EMBEDDED:
+            embedded_ready([lc])
         print("Listening for gamepad button presses...")
         if TRIGGER_DEPTH == 0:
             print("Fully press and release your right trigger.")
         try:
-            for event in device.read_loop():
-                lc.process_frame_linux(event)
+            loop.run_forever()
         except KeyboardInterrupt:
+            print("\rExiting")
+            print(lc.midi.report())
+            if lc.controllers:
+                lc.controllers.close()
+                print(lc.controllers.report())
+            for writer in writers:
+                writer.close()
+                print(writer.report())
+            for sink in extras:
+                sink.close()
+            if MEASURE_LATENCY:
+                print(lc.latency_report())
+            if recorder:
+                recorder.close()
+            if clock:
+                clock.close()
+                print(clock.report())
+            if song:
+                song.close()
+            if metrics:
+                metrics.close()
+            link.close()
+            print(loop.report())
+            loop.close()
+            if lc.rumble_pool:
+                lc.rumble_pool.close()
+            lc.saves.close()
             del device
             del midi_out
-            print("\rExiting")
 
 
 
@@ -827,6 +2801,8 @@ def main():
         port_index = lc.ensure_virtual_port()
         midi_out.open_port(port_index)
         atexit.register(lambda: midi_out.close_port())
+        atexit.register(lc.saves.close)
+        clock = start_clock([lc])
         print("Listening for gamepad button presses...")
         if TRIGGER_DEPTH == 0:
             print("Fully press and release your right trigger.")
@@ -838,7 +2814,22 @@ def main():
                 lc.process_frame_windows()
         except KeyboardInterrupt:
             print("\rExiting")
-
-
-
-main()
\ No newline at end of file
+            if clock:
+                clock.close()
+                print(clock.report())
+            if song:
+                song.close()
+            print(lc.midi.report())
+            if lc.controllers:
+                lc.controllers.close()
+                print(lc.controllers.report())
+            for writer in writers:
+                writer.close()
+                print(writer.report())
+            for sink in extras:
+                sink.close()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+'''replay controller events recorded with RECORD_EVENTS through LoChord, with no controller or MIDI port needed.
+
+python replay.py recording.lcr                  # as fast as possible, prints timing
+python replay.py recording.lcr --realtime       # at the speed it was recorded
+python replay.py recording.lcr --out a.mid.bin  # save the MIDI that came out
+python replay.py recording.lcr --compare a.mid.bin  # fail if the MIDI differs from a previous run
+'''
+import os
+import sys
+import argparse
+import hashlib
+import shutil
+import tempfile
+import time
+from evdev.events import InputEvent
+import lochord
+
+
+class MockMidiOut:
+    '''stands in for rtmidi.MidiOut and keeps everything that gets sent'''
+    def __init__(self) -> None:
+        self.messages: list[ tuple[float, bytes] ] = []
+
+    def send_message(self, message: list[int]) -> None:
+        self.messages.append( (time.perf_counter(), bytes(message)) )
+
+    def data(self) -> bytes:
+        return b"".join(message for stamp, message in self.messages)
+
+
+def read_recording(path: str) -> tuple[int, str, list[ tuple[int, int, int, int, int] ]]:
+    '''returns trigger depth, device name and the raw events'''
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:4] != lochord.EventRecorder.MAGIC:
+        raise ValueError(f"{path} isn't a LoChord event recording")
+    offset = 4
+    depth, name_length = lochord.EventRecorder.HEADER.unpack_from(data, offset)
+    offset += lochord.EventRecorder.HEADER.size
+    name = data[offset:offset + name_length].decode(errors="replace")
+    offset += name_length
+    events = list(lochord.EventRecorder.EVENT.iter_unpack(data[offset:]))
+    return depth, name, events
+
+
+def replay(events: list, realtime: bool = False) -> tuple[MockMidiOut, list[float], float]:
+    '''feed events through a fresh LoChord. returns the captured MIDI, per-event processing times and total wall time'''
+    midi_out = MockMidiOut()
+    lochord.midi_out = midi_out
+    lc = lochord.LoChord()
+    handle = lc.queue_event_linux if lochord.COALESCE_FRAMES else lc.process_frame_linux
+    times = []
+    start = time.perf_counter()
+    first = None
+    for sec, usec, type, code, value in events:
+        event = InputEvent(sec, usec, type, code, value)
+        if realtime:
+            stamp = sec + usec / 1_000_000
+            if first is None:
+                first = stamp
+            delay = start + (stamp - first) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        before = time.perf_counter()
+        handle(event)
+        times.append(time.perf_counter() - before)
+    lc.saves.close()
+    return midi_out, times, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="replay recorded controller events through LoChord")
+    parser.add_argument("recording")
+    parser.add_argument("--realtime", action="store_true", help="keep the recorded timing instead of going flat out")
+    parser.add_argument("--out", help="write the MIDI bytes that came out to this file")
+    parser.add_argument("--compare", help="exit with an error if the MIDI bytes differ from this file")
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    depth, name, events = read_recording(args.recording)
+    lochord.TRIGGER_DEPTH = depth
+    print(f"{len(events)} events from {name}, trigger depth {depth}")
+
+    # saving during the recording shouldn't touch your real save slots
+    workdir = tempfile.mkdtemp(prefix="lochord-replay-")
+    default = os.path.join(os.path.dirname(os.path.abspath(lochord.__file__)), "default.txt")
+    if os.path.exists(default):
+        shutil.copy(default, workdir)
+    lochord.SAVE_DIR = workdir
+    try:
+        midi_out, times, wall = replay(events, args.realtime)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    data = midi_out.data()
+    times.sort()
+    print(f"{len(events) / wall:,.0f} events/sec ({wall:.3f} s)")
+    if times:
+        print(f"per event: mean {sum(times) / len(times) * 1e6:.1f} us, "
+            f"p99 {times[int(len(times) * 0.99)] * 1e6:.1f} us, max {times[-1] * 1e6:.1f} us")
+    print(f"{len(midi_out.messages)} MIDI messages, sha256 {hashlib.sha256(data).hexdigest()}")
+
+    if out:
+        with open(out, "wb") as file:
+            file.write(data)
+    if compare:
+        with open(compare, "rb") as file:
+            if file.read() != data:
+                print(f"MIDI output differs from {compare}!")
+                sys.exit(1)
+        print(f"MIDI output matches {compare}.")
+
+
+if __name__ == "__main__":
+    main()